@@ -0,0 +1,85 @@
+# Microbenchmark of Provider date and text normalization
+#
+# Usage: python benchmarks/normalize.py [number of repetitions]
+#
+# Compares the original per-call implementations (arrow.get on every date,
+# chained str.replace plus an uncompiled re.sub on every string) with
+# providers/normalize.py on a realistic mix: a handful of dates repeated
+# across an albo and the text cells of the recorded fixture pages.
+
+import os, re, sys, timeit, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import arrow, lxml.html
+from providers import normalize
+from providers.Provider import Provider
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def legacy_format_datetime(ar, input_format, tz, output_format):
+    if isinstance(ar,arrow.arrow.Arrow):
+        return ar.strftime(output_format)
+    elif isinstance(ar,str) and ar:
+        return legacy_format_datetime(arrow.get(ar,input_format).replace(tzinfo=tz), input_format, tz, output_format)
+    else:
+        return ""
+
+def legacy_clean_string(old_string):
+    if not old_string:
+        return ""
+    new_string = old_string
+    chars = ["\n","\t","\r"]
+    for c in chars:
+        new_string = new_string.replace(c," ")
+    new_string = re.sub(r" {2,}", " ", new_string)
+    return new_string.strip()
+
+random.seed(0)
+output_format = Provider.output_format
+# 300 items with pubStart, pubEnd and act date drawn from a few days
+dates = [("%02d/03/2017" % random.randint(1, 10), "DD/MM/YYYY") for i in range(900)]
+dates += [("%d/3/2017" % random.randint(1, 10), "D/M/YYYY") for i in range(300)]
+cells = []
+for name in os.listdir(fixtures):
+    if name.endswith(".html"):
+        with open(os.path.join(fixtures, name), "rb") as f:
+            cells += [el.text_content() for el in lxml.html.fromstring(f.read()).iter("td", "div", "a", "th")]
+
+def check():
+    for value, input_format in dates + [("31/02/2017", "DD/MM/YYYY"), ("1/3/2017", "DD/MM/YYYY"), ("01/03/2017 10:00", "DD/MM/YYYY")]:
+        try:
+            expected = legacy_format_datetime(value, input_format, "Europe/Rome", output_format)
+        except Exception as e:
+            expected = type(e)
+        try:
+            result = normalize.format_datetime(value, input_format, "Europe/Rome", output_format)
+        except Exception as e:
+            result = type(e)
+        assert expected == result, (value, expected, result)
+    for cell in cells + [" a \n\t b  ", "\r\n", "x\xa0 y", ""]:
+        assert legacy_clean_string(cell) == normalize.clean_string(cell), repr(cell)
+
+if __name__ == "__main__":
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    check()
+
+    cases = [
+        ("format_datetime", len(dates),
+            lambda: [legacy_format_datetime(v, f, "Europe/Rome", output_format) for v, f in dates],
+            lambda: [normalize.format_datetime(v, f, "Europe/Rome", output_format) for v, f in dates]),
+        ("clean_string", len(cells),
+            lambda: [legacy_clean_string(c) for c in cells],
+            lambda: normalize.clean_strings(cells))
+    ]
+
+    print("%-16s %8s %14s %14s %8s" % ( "function" , "calls" , "legacy us/call" , "new us/call" , "speedup" ))
+    for name, calls, legacy, new in cases:
+        legacy_time = timeit.timeit(legacy, number = number) / number / calls * 1e6
+        new_time = timeit.timeit(new, number = number) / number / calls * 1e6
+        print("%-16s %8d %14.2f %14.2f %7.1fx" % ( name , calls , legacy_time , new_time , legacy_time / new_time ))
+
+    # Cold cache: only the fast path, no memoization
+    normalize.format_date_string.cache_clear()
+    cold = timeit.timeit(lambda: [normalize.format_date_string.__wrapped__(v, f, "Europe/Rome", output_format) for v, f in dates], number = number) / number / len(dates) * 1e6
+    print("%-16s %8d %14s %14.2f" % ( "  (uncached)" , len(dates) , "" , cold ))
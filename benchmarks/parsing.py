@@ -0,0 +1,72 @@
+# Parsing benchmark: bs4 reference backend vs lxml fast path
+#
+# Usage: python benchmarks/parsing.py [number of repetitions]
+#
+# Parses the recorded pages in benchmarks/fixtures with both backends,
+# checks that the resulting items are identical and prints the time per page.
+
+import os, sys, timeit, warnings
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from providers.Halley import Halley
+from providers.Task import Task1, Task2
+
+# The bs4 backend parses the grid XML with the HTML parser, as it always did
+warnings.filterwarnings("ignore", message = ".*XML document.*")
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def fixture(name):
+    with open(os.path.join(fixtures, name), "rb") as f:
+        return f.read()
+
+def provider(cls, parser):
+    p = cls()
+    p.parser = parser
+    if cls is Halley:
+        p.opts("c000000")
+    else:
+        p.opts("http://127.0.0.1:8765/task_index.html")
+        list(p.parse_urls(p.options["index_url"], fixture("task_index.html")))
+    return p
+
+# Item of a Task single item page, parsed as in Task.item()
+def task_item(p, single_page_url, content):
+    description, id, record, enclosures = p.parse_page(content)
+    return p.page_item(single_page_url, description, id, dict(p.index_rows.get(id, {}), **record), enclosures)
+
+# (name, provider class, parse function) for every recorded page
+cases = [
+    ("Halley grid", Halley, lambda p: list(p.parse_urls(fixture_cache["halley_grid.xml"]))),
+    ("Halley detail", Halley, lambda p: p.parse_item("http://halleyweb.com/c000000/mc/mc_gridev_dettaglio.php?id_pubbl=1", fixture_cache["halley_detail.html"])),
+    ("Task index", Task1, lambda p: list(p.parse_urls(p.options["index_url"], fixture_cache["task_index.html"]))),
+    ("Task1 detail", Task1, lambda p: task_item(p, "http://127.0.0.1:8765/task1_detail.html", fixture_cache["task1_detail.html"])),
+    ("Task2 detail", Task2, lambda p: task_item(p, "http://127.0.0.1:8765/task2_detail.html", fixture_cache["task2_detail.html"]))
+]
+
+fixture_cache = {name: fixture(name) for name in os.listdir(fixtures)}
+
+def comparable(result):
+    if isinstance(result, list):
+        return result
+    return result.to_dict()
+
+if __name__ == "__main__":
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print("%-15s %12s %12s %8s" % ( "page" , "bs4 ms" , "lxml ms" , "speedup" ))
+
+    for name, cls, parse in cases:
+
+        reference = provider(cls, "bs4")
+        fast = provider(cls, "lxml")
+
+        if comparable(parse(reference)) != comparable(parse(fast)):
+            print("%-15s OUTPUT MISMATCH" % name)
+            sys.exit(1)
+
+        bs4_time = timeit.timeit(lambda: parse(reference), number = number) / number * 1000
+        lxml_time = timeit.timeit(lambda: parse(fast), number = number) / number * 1000
+
+        print("%-15s %12.3f %12.3f %7.1fx" % ( name , bs4_time , lxml_time , bs4_time / lxml_time ))
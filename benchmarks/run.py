@@ -0,0 +1,197 @@
+# Offline benchmark suite: providers and scraper.py against the local albo server
+#
+# Usage: python benchmarks/run.py [--halley 20] [--task 4] [--items 50] [--latency 0.05]
+#                                 [--jitter 0.02] [--errors 0] [--host-requests 64]
+#                                 [--host-rate 0] [--skip-scraper]
+#                                 [-- extra scraper.py arguments]
+#
+# 1. Providers: every source is scraped in-process through the fetch engine,
+#    per source are reported requests, pages/s, items/s and p50/p99 latency.
+# 2. scraper.py: run end to end in a subprocess on a generated CSV,
+#    reported are wall time, pages/s, items/s and peak RSS.
+# No request leaves the machine: all sources point to benchmarks/server.py.
+# All sources share the same local host, so per-host politeness limits are
+# relaxed by default (--host-requests, --host-rate) for both runs, and the
+# connection pool is sized to --host-requests.
+
+import os, sys, csv, time, shutil, asyncio, argparse, tempfile, resource, subprocess
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+import server
+from providers import providers, fetch, politeness, sessions
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+# CSV rows of elenco_albi.csv format pointing to the local server
+def sources(base_url, halley, task):
+    rows = []
+    for n in range(halley + task):
+        if n < halley:
+            provider, options = "Halley", "%s/halley/c%06d/mc/" % ( base_url , n )
+        else:
+            kind = "task1" if n % 2 else "task2"
+            provider, options = kind.capitalize(), "%s/%s/c%06d/index.html" % ( base_url , kind , n )
+        rows.append({
+            "id": "c%06d" % n,
+            "feed_name": "Bench%06d_feed.xml" % n,
+            "channel-category-type": "Comune",
+            "channel-category-municipality": "Bench %d" % n,
+            "channel-category-province": "",
+            "channel-category-region": "",
+            "channel-category-latitude": "",
+            "channel-category-longitude": "",
+            "channel-category-country": "Italia",
+            "channel-category-name": "Bench %d" % n,
+            "channel-category-uid": "istat:%06d" % n,
+            "docs": "http://albopop/comune/bench%d" % n,
+            "webmaster": "bench@example.org (Benchmark)",
+            "provider": provider,
+            "options": options
+        })
+    return rows
+
+def write_csv(path, rows):
+    with open(path, "w", newline = "") as f:
+        writer = csv.DictWriter(f, fieldnames = list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+# Scrape every source in-process, concurrently, and collect per-source stats
+async def bench_providers(rows):
+
+    stats = {row["id"]: {"provider": row["provider"], "latencies": [], "bytes": 0, "items": 0} for row in rows}
+    # Pages of a source are in the directory of its index page (.../halley/c000000/mc/, .../task1/c000001/)
+    prefixes = [(row["options"].rsplit("/", 1)[0] + "/", row["id"]) for row in rows]
+
+    def observe(method, url, status, size, elapsed):
+        for prefix, source in prefixes:
+            if url.startswith(prefix):
+                stats[source]["latencies"].append(elapsed)
+                stats[source]["bytes"] += size
+                return
+
+    async def scrape(row):
+        p = getattr(providers, row["provider"])().opts(row["options"])
+        start = time.perf_counter()
+        async for item in p.scrape():
+            stats[row["id"]]["items"] += 1
+        stats[row["id"]]["elapsed"] = time.perf_counter() - start
+
+    fetch.observers.append(observe)
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*[scrape(row) for row in rows])
+        elapsed = time.perf_counter() - start
+    finally:
+        fetch.observers.remove(observe)
+        await fetch.close()
+
+    return stats, elapsed
+
+def report_providers(stats, elapsed):
+
+    print("\n== Providers (in-process) ==")
+    print("%-9s %-7s %6s %6s %9s %9s %9s %9s" % ( "source" , "provider" , "pages" , "items" , "pages/s" , "items/s" , "p50 ms" , "p99 ms" ))
+
+    pages = items = 0
+    latencies = []
+    for source, s in sorted(stats.items()):
+        n = len(s["latencies"])
+        pages += n
+        items += s["items"]
+        latencies += s["latencies"]
+        print("%-9s %-7s %6d %6d %9.1f %9.1f %9.1f %9.1f" % (
+            source, s["provider"], n, s["items"],
+            n / s["elapsed"], s["items"] / s["elapsed"],
+            percentile(s["latencies"], 50) * 1000, percentile(s["latencies"], 99) * 1000
+        ))
+
+    print("%-17s %6d %6d %9.1f %9.1f %9.1f %9.1f" % (
+        "TOTAL", pages, items, pages / elapsed, items / elapsed,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+    ))
+    print("Wall time %.2f s, peak RSS %.1f MB" % ( elapsed , resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 ))
+
+# Run scraper.py end to end in a subprocess
+def bench_scraper(albo, csv_path, sources, extra_args):
+
+    download_dir = tempfile.mkdtemp(prefix = "bench_feeds_")
+    served = albo.stats()["served"]
+
+    try:
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, os.path.join(root, "scraper.py"), csv_path, download_dir] + extra_args, stderr = subprocess.PIPE)
+        elapsed = time.perf_counter() - start
+
+        items = 0
+        for name in os.listdir(download_dir):
+            with open(os.path.join(download_dir, name), encoding = "utf-8") as f:
+                items += f.read().count("<item>")
+        feeds = len(os.listdir(download_dir))
+    finally:
+        shutil.rmtree(download_dir)
+
+    # A run that lost sources is not a valid measure: show its log and fail
+    if result.returncode or feeds < sources:
+        sys.stderr.write(result.stderr.decode("utf-8", errors = "replace"))
+        sys.exit("scraper.py wrote %d feeds out of %d sources (exit status %d)" % ( feeds , sources , result.returncode ))
+
+    pages = albo.stats()["served"] - served
+
+    print("\n== scraper.py (end to end) ==")
+    print("%d feeds, %d pages, %d items in %.2f s: %.1f pages/s, %.1f items/s, peak RSS %.1f MB" % (
+        feeds, pages, items, elapsed, pages / elapsed, items / elapsed,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    ))
+
+if __name__ == "__main__":
+
+    argv = sys.argv[1:]
+    extra_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    argv = argv[:argv.index("--")] if "--" in argv else argv
+
+    parser = argparse.ArgumentParser(description = "Offline benchmark of providers and scraper.py")
+    parser.add_argument("--halley", type = int, default = 20, help = "Halley sources (default: 20)")
+    parser.add_argument("--task", type = int, default = 4, help = "Task1/Task2 sources (default: 4)")
+    parser.add_argument("--items", type = int, default = 50, help = "items per source (default: 50)")
+    parser.add_argument("--latency", type = float, default = 0.05, help = "server latency in seconds (default: 0.05)")
+    parser.add_argument("--jitter", type = float, default = 0.02, help = "server latency jitter in seconds (default: 0.02)")
+    parser.add_argument("--errors", type = float, default = 0.0, help = "fraction of 503 responses (default: 0)")
+    parser.add_argument("--host-requests", type = int, default = 64, help = "in-flight requests to the local host (default: 64)")
+    parser.add_argument("--host-rate", type = float, default = 0, help = "requests per second to the local host, 0 for unlimited (default: 0)")
+    parser.add_argument("--skip-scraper", action = "store_true", help = "only benchmark providers in-process")
+    args = parser.parse_args(argv)
+
+    albo = server.start(latency = args.latency, jitter = args.jitter, errors = args.errors, items = args.items)
+    rows = sources(albo.base_url, args.halley, args.task)
+
+    print("Local albo server on %s: %d sources, %d items each, latency %.0f+/-%.0f ms, %.1f%% errors" % (
+        albo.base_url, len(rows), args.items, args.latency * 1000, args.jitter * 1000, args.errors * 100
+    ))
+
+    try:
+
+        politeness.configure(max_concurrency = args.host_requests, max_rate = args.host_rate)
+        sessions.configure(pool_size = args.host_requests)
+        report_providers(*asyncio.run(bench_providers(rows)))
+
+        if not args.skip_scraper:
+            csv_path = os.path.join(tempfile.mkdtemp(prefix = "bench_csv_"), "elenco_albi.csv")
+            write_csv(csv_path, rows)
+            try:
+                bench_scraper(albo, csv_path, len(rows), [
+                    "--host-sources", str(len(rows)),
+                    "--host-requests", str(args.host_requests),
+                    "--host-rate", str(args.host_rate),
+                    "--pool-size", str(args.host_requests)
+                ] + extra_args)
+            finally:
+                shutil.rmtree(os.path.dirname(csv_path))
+
+    finally:
+        albo.stop()
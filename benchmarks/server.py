@@ -0,0 +1,160 @@
+# Local stand-in albo pretorio server for offline benchmarks
+#
+# Usage: python benchmarks/server.py [--port 8765] [--latency 0.05] [--jitter 0.02] [--errors 0.01] [--items 50]
+#
+# Serves the recorded pages in benchmarks/fixtures with HTTP/1.1 keep-alive:
+# - /halley/<comune>/mc/mc_gridev_messi_datigrid.php: Halley grid XML
+# - /halley/<comune>/mc/mc_gridev_dettaglio.php?id_pubbl=<id>: Halley detail page
+# - /task1/<comune>/index.html and /task2/<comune>/index.html: Task index page
+# - /task1/<comune>/detail.html?n=<n> and /task2/...: Task1 and Task2 detail pages
+# Every response is delayed by latency +/- jitter seconds and a fraction of
+# them (errors) fails with 503. Indexes list the first items rows only.
+
+import os, re, sys, time, random, argparse, threading, multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def fixture(name):
+    with open(os.path.join(fixtures, name), "rb") as f:
+        return f.read()
+
+class AlboServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, latency = 0.05, jitter = 0.02, errors = 0.0, items = 50, counters = None):
+        ThreadingHTTPServer.__init__(self, address, AlboHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.items = items
+        self.lock = threading.Lock()
+        # served, failed and bytes counters, shared with the parent process when started by start()
+        self.counters = counters or [multiprocessing.Value("l", 0, lock = False) for i in range(3)]
+        self.pages = {name: fixture(name) for name in os.listdir(fixtures)}
+        self.base_url = "http://%s:%d" % self.server_address[:2]
+
+    # Grid XML with the first self.items rows
+    def halley_grid(self):
+        grid = self.pages["halley_grid.xml"]
+        rows = re.findall(rb"<row .*?</row>", grid)[:self.items]
+        return b'<?xml version="1.0" encoding="UTF-8"?>\n<rows>\n' + b"\n".join(rows) + b"\n</rows>\n"
+
+    # Task index with the first self.items rows, linking to this server
+    def task_index(self, prefix):
+        index = self.pages["task_index.html"]
+        rows = re.findall(rb"<tr><td>.*?</tr>", index)
+        index = index.replace(b"\n".join(rows), b"\n".join(rows[:self.items]))
+        return index.replace(b"http://127.0.0.1:8765/task1_detail.html", (self.base_url + prefix + "detail.html").encode("utf-8"))
+
+    def page(self, path):
+        if path.startswith("/halley/"):
+            if path.endswith("/mc_gridev_messi_datigrid.php"):
+                return "text/xml", self.halley_grid()
+            if path.endswith("/mc_gridev_dettaglio.php"):
+                return "text/html; charset=utf-8", self.pages["halley_detail.html"]
+        for kind in ("task1", "task2"):
+            if path.startswith("/%s/" % kind):
+                if path.endswith("/index.html"):
+                    return "text/html; charset=utf-8", self.task_index(path[:-len("index.html")])
+                if path.endswith("/detail.html"):
+                    return "text/html; charset=utf-8", self.pages["%s_detail.html" % kind]
+        return None, None
+
+    # Clients giving up on slow responses (request timeouts) are expected
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def count(self, size, failed = False):
+        with self.lock:
+            self.counters[0].value += 1
+            self.counters[1].value += failed
+            self.counters[2].value += size
+
+    def stats(self):
+        return stats(self.counters)
+
+def stats(counters):
+    return {"served": counters[0].value, "failed": counters[1].value, "bytes": counters[2].value}
+
+class AlboHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+
+        server = self.server
+        time.sleep(max(0, server.latency + random.uniform(-server.jitter, server.jitter)))
+
+        if random.random() < server.errors:
+            server.count(0, failed = True)
+            return self.respond(503, "text/plain", b"Service Unavailable")
+
+        content_type, body = server.page(urlsplit(self.path).path)
+        if body is None:
+            server.count(0, failed = True)
+            return self.respond(404, "text/plain", b"Not Found")
+
+        server.count(len(body))
+        self.respond(200, content_type, body)
+
+    do_HEAD = do_GET
+
+# Handle of a server running in a separate process, so that it does not
+# compete for the GIL with the code being benchmarked
+class ServerProcess():
+
+    def __init__(self, **settings):
+        self.counters = [multiprocessing.Value("l", 0) for i in range(3)]
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target = _serve, args = (ready, self.counters), kwargs = settings, daemon = True)
+        self.process.start()
+        self.base_url = ready.get(timeout = 30)
+
+    def stats(self):
+        return stats(self.counters)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+def _serve(ready, counters, port = 0, **settings):
+    server = AlboServer(("127.0.0.1", port), counters = counters, **settings)
+    ready.put(server.base_url)
+    server.serve_forever()
+
+# Start a server in a separate process, return its handle
+def start(**settings):
+    return ServerProcess(**settings)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Local stand-in albo pretorio server")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--latency", type = float, default = 0.05, help = "seconds added to every response (default: 0.05)")
+    parser.add_argument("--jitter", type = float, default = 0.02, help = "random +/- seconds on latency (default: 0.02)")
+    parser.add_argument("--errors", type = float, default = 0.0, help = "fraction of 503 responses (default: 0)")
+    parser.add_argument("--items", type = int, default = 50, help = "items listed by every index (default: 50)")
+    args = parser.parse_args()
+
+    server = AlboServer(("127.0.0.1", args.port), latency = args.latency, jitter = args.jitter, errors = args.errors, items = args.items)
+    print("Serving fixtures on %s" % server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats())
+        sys.exit()
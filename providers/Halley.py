@@ -2,12 +2,15 @@
 
 # Mandatory imports
 from .Provider import Provider
-from rfeed import *
+from .records import ItemRecord
 
 # Optional imports
-import requests, mimetypes, logging
+import mimetypes, logging, html
 logging.basicConfig(level=logging.INFO)
 from bs4 import BeautifulSoup as bs
+from lxml import etree
+import lxml.html
+from io import BytesIO
 
 # Halley provider class inherit from the Provider one defined in providers/Provider.py file
 #
@@ -18,15 +21,22 @@ from bs4 import BeautifulSoup as bs
 # - feed_base_url
 # - docs_base_url
 # - specs_base_url
+# - concurrency
+# - parser
 # - options
 #
 # Inherited methods:
 # - dt
+# - get: async fetch of a page through the shared engine
+# - items: generic async wrapper around item()
+# - scrape: public method called by scraper.py
 #
 # Specific methods to customize:
 # - opts: using options from csv file properly
-# - urls: extract single item urls from index page
-# - item: extract and structure data from single item page
+# - urls: extract single item urls from index page (async generator)
+# - item: fetch single item page and pass it to parse_item
+# - parse_urls / parse_item: parse fetched pages, with self.parser backend (lxml or bs4)
+# - stored_item: refresh known acts from the grid, in index-only mode
 #
 # WARNING: class name is also the value of provider column in elenco_albi.csv
 #
@@ -36,49 +46,144 @@ class Halley(Provider):
     input_format = "DD/MM/YYYY"
 
     # Optional attributes
-    # ...
+    # Fields of the grid XML rows, in cell order, for the index-only mode:
+    # a cell named "A/B" holds two fields separated by a slash, None is skipped
+    grid_columns = ("Numero Pubblicazione/Anno di Pubblicazione", "Tipo Atto", "Oggetto Atto", "Data Inizio Pubblicazione", "Data Fine Pubblicazione", "Mittente")
+
+    # Fields an item cannot be built without
+    grid_required = ("Numero Pubblicazione", "Anno di Pubblicazione", "Oggetto Atto", "Data Inizio Pubblicazione")
+
+    # Date fields of single item pages and grid rows
+    date_fields = ("Data Atto", "Data Inizio Pubblicazione", "Data Fine Pubblicazione")
+
+    def __init__(self):
+        Provider.__init__(self)
+        self.grid_rows = {} # grid fields by act id, in index-only mode
 
     # Transform and prepare options from CSV row (options column)
+    # A full url can be given instead of the halleyweb.com code (e.g. a local test server)
     def opts(self, opt):
-        self.options["base_url"] = "http://halleyweb.com/%s/mc/" % opt
+        if opt.startswith("http"):
+            self.options["base_url"] = opt.rstrip("/") + "/"
+        else:
+            self.options["base_url"] = "http://halleyweb.com/%s/mc/" % opt
+        self.options["index_url"] = self.options["base_url"] + "mc_gridev_messi_datigrid.php"
         return self # Mandatory for chaining
 
-    # Scrape index page and return single item urls
-    def urls(self):
+    # Scrape index page and yield single item urls
+    async def urls(self):
 
-        index_page_url = self.options["base_url"] + "mc_gridev_messi_datigrid.php"
-        index_page_response = requests.get(index_page_url)
+        index_page_url = self.options["index_url"]
+        index_page_response = await self.get(index_page_url, index = True)
 
         # Manage exceptions and return consistent values
         if index_page_response.status_code != 200:
             logging.warning("Index page %s unavailable!" % index_page_url)
-            return []
+            return
 
-        # Parsing with BeautifulSoup
-        index_page_soup = bs(index_page_response.content,"lxml")
         logging.info("Scraping %s:" % index_page_url)
 
-        # Very simple scraping of single item urls
-        for row in index_page_soup.findAll("row"):
+        for single_page_url in self.parse_urls(index_page_response.content):
+            yield single_page_url
 
-            single_page_id = row['id'].strip()
-            single_page_url =  self.options["base_url"] + "mc_gridev_dettaglio.php?id_pubbl=%s" % single_page_id
+    # Very simple scraping of single item urls from the grid XML
+    def parse_urls(self, content):
 
-            yield single_page_url
+        if self.index_only and self.store is not None:
+            self.grid_rows = self.grid_rows_lxml(content)
+            ids = list(self.grid_rows)
+        elif self.parser == "lxml":
+            ids = self.grid_ids_lxml(content)
+        else:
+            ids = [row['id'] for row in bs(content,"lxml").findAll("row")]
+
+        for single_page_id in ids:
+            yield self.detail_url(single_page_id)
+
+    def detail_url(self, single_page_id):
+        return self.options["base_url"] + "mc_gridev_dettaglio.php?id_pubbl=%s" % single_page_id.strip()
+
+    # Stream row ids with iterparse, without building the whole tree
+    def grid_ids_lxml(self, content):
+        try:
+            ids = []
+            for event, row in etree.iterparse(BytesIO(content), events = ("end",), tag = "row"):
+                ids.append(row.get("id"))
+                row.clear()
+            return ids
+        except etree.XMLSyntaxError:
+            # Broken XML: fall back to the forgiving HTML parser, as BeautifulSoup did
+            return lxml.html.fromstring(content).xpath("//row/@id")
+
+    # Fields of every grid row by act id, cells are HTML in CDATA sections
+    def grid_rows_lxml(self, content):
+
+        try:
+            rows = [
+                ( row.get("id") , [cell.text or "" for cell in row.iterfind("cell")] )
+                for event, row in etree.iterparse(BytesIO(content), events = ("end",), tag = "row")
+            ]
+        except etree.XMLSyntaxError:
+            rows = [
+                ( row.get("id") , [cell.text_content() for cell in row.iterfind("cell")] )
+                for row in lxml.html.fromstring(content).iter("row")
+            ]
+
+        grid_rows = {}
+        for id, cells in rows:
+            fields = {}
+            for column, cell in zip(self.grid_columns, cells):
+                if column is None:
+                    continue
+                names = column.split("/")
+                values = self.clean_string(html.unescape(cell)).split("/", len(names) - 1)
+                if len(values) == len(names):
+                    fields.update(zip(names, [value.strip() for value in values]))
+            grid_rows[id.strip()] = fields
 
-    # Scrape a single item page from its url and return structured data as Item() instance (from rfeed)
-    def item(self,single_page_url):
+        return grid_rows
 
-        single_page_response = requests.get(single_page_url)
+    # Index-only mode: known acts are refreshed from their grid row (e.g. a
+    # new object or end of publication) without fetching their page again.
+    # Enclosures and "Data Atto" (the pubDate) are only listed in single item
+    # pages: they are kept from the stored item, so that items are the same as
+    # in the full mode. Pages of new acts are fetched by Provider.stored_items()
+    def stored_item(self, guid, item):
+
+        # Grid rows are dropped as soon as their item is built
+        single_page_id = guid.rsplit("id_pubbl=", 1)[-1]
+        document = self.grid_rows.pop(single_page_id, None)
+        if not document or not all(document.get(field) for field in self.grid_required):
+            return item
+
+        refreshed = self.document_item(guid, dict(document, Documento = [], Allegati = []))
+        refreshed.pubDate = item.pubDate
+        refreshed.enclosures = item.enclosures
+        if refreshed.to_dict() != item.to_dict():
+            self.store.put(self.source, refreshed)
+        return refreshed
+
+    # Forget grid rows left by items that were not built from them
+    def forget(self):
+        self.grid_rows = {}
+
+    # Scrape a single item page from its url and return structured data as an ItemRecord
+    async def item(self,single_page_url):
+
+        single_page_response = await self.get(single_page_url)
 
         if single_page_response.status_code != 200 or "non può essere visualizzato" in single_page_response.text:
             print("Single page %s unavailable!" % single_page_url)
             return None # None items are dropped in final feed
 
-        single_page_soup = bs(single_page_response.content,"lxml")
         logging.debug("- Scraping %s" % single_page_url)
+        return await self.parse("parse_item", single_page_url, single_page_response.content)
+
+    # Cells of the single item page table: a string or a list of links per cell
+    def parse_cells_bs4(self, content):
+
+        single_page_soup = bs(content,"lxml")
 
-        ### MAIN SCRAPING LOGIC ###
         contents = []
         for cell in single_page_soup.select("td"):
             if cell.findAll('a'):
@@ -99,71 +204,97 @@ class Halley(Provider):
             else:
                 contents.append(self.clean_string(cell.text).strip(':'))
 
+        return contents
+
+    # Same as parse_cells_bs4() with lxml and XPath, several times faster
+    def parse_cells_lxml(self, content):
+
+        single_page_tree = self.html_tree(content)
+
+        contents = []
+        for cell in single_page_tree.iter("td"):
+            anchors = self.xpath(cell, ".//a")
+            if anchors:
+                contents.append([])
+                for a in anchors:
+
+                    # Same attribute checks as parse_cells_bs4(), output must not change
+                    if a.get('onlick'):
+                        href = a.get('onclick', "").replace("window.open('","").replace("');","")
+                    elif a.get('href'):
+                        href = a.get('href')
+                    else:
+                        href = ""
+
+                    contents[-1].append({
+                        "content": self.clean_string(a.text_content()),
+                        "href": self.options["base_url"] + self.clean_string(href)
+                    })
+            else:
+                contents.append(self.clean_string(cell.text_content()).strip(':'))
+
+        return contents
+
+    # Structure data of a single item page as an ItemRecord
+    def parse_item(self, single_page_url, content):
+
+        ### MAIN SCRAPING LOGIC ###
+        if self.parser == "lxml":
+            contents = self.parse_cells_lxml(content)
+        else:
+            contents = self.parse_cells_bs4(content)
+
         document = dict([tuple(contents[i:i+2]) for i in range(0,len(contents),2)])
 
         document["Documento"] = document["Documento"] if "Documento" in document and isinstance(document["Documento"],list) else []
         document["Allegati"] = document["Allegati"] if "Allegati" in document and isinstance(document["Allegati"],list) else []
         ### END SCRAPING LOGIC ###
 
-        # Return scraping data as an Item() instance
-        return Item(
+        return self.document_item(single_page_url, document)
+
+    # Return scraping data as an item record (providers/records.py)
+    def document_item(self, single_page_url, document):
+
+        document = self.normalize_record(document, self.date_fields)
+
+        return ItemRecord(
             title = document["Oggetto Atto"],
             link = single_page_url,
             description = document["Oggetto Atto"],
-            pubDate = self.format_datetime(document.get("Data Atto") or document.get("Data Inizio Pubblicazione")),
-            guid = Guid(single_page_url),
+            pubDate = document.get("Data Atto") or document.get("Data Inizio Pubblicazione") or "",
+            guid = single_page_url,
             categories = [
                 c
                 for c in [
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-uid",
-                        category = "%s/%s" % (document["Anno di Pubblicazione"], document["Numero Pubblicazione"])
+                    (
+                        self.specs_base_url + "#" + "item-category-uid",
+                        "%s/%s" % (document["Anno di Pubblicazione"], document["Numero Pubblicazione"])
                     ),
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-type",
-                        category = document["Tipo Atto"]
+                    (
+                        self.specs_base_url + "#" + "item-category-type",
+                        document["Tipo Atto"]
                     ) if document.get("Tipo Atto") else None,
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-pubStart",
-                        category = self.format_datetime(document.get("Data Inizio Pubblicazione") or document.get("Data Atto"))
+                    (
+                        self.specs_base_url + "#" + "item-category-pubStart",
+                        document.get("Data Inizio Pubblicazione") or document.get("Data Atto") or ""
                     ),
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-pubEnd",
-                        category = self.format_datetime(document["Data Fine Pubblicazione"])
+                    (
+                        self.specs_base_url + "#" + "item-category-pubEnd",
+                        document["Data Fine Pubblicazione"]
                     ) if document.get("Data Fine Pubblicazione") else None,
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-unit",
-                        category = document["Mittente"]
+                    (
+                        self.specs_base_url + "#" + "item-category-unit",
+                        document["Mittente"]
                     ) if document.get("Mittente") else None
                 ]
                 if c is not None
             ],
-            enclosure = [
-                Enclosure(
-                    url = enclosure["href"],
-                    length = 3000,
-                    type = mimetypes.guess_type(enclosure["content"])[0] or "application/octet-stream"
+            enclosures = [
+                (
+                    enclosure["href"],
+                    3000,
+                    mimetypes.guess_type(enclosure["content"])[0] or "application/octet-stream"
                 )
                 for enclosure in document["Documento"] + document["Allegati"]
             ]
         )
-
-    # Simple and generic wrapper around item() method if a list of urls is passed
-    # Unavailable items are filtered out
-    def items(self, single_page_urls):
-
-        for single_page_url in single_page_urls:
-
-            try:
-                item = self.item(single_page_url)
-            except Exception as e:
-                logging.warning("Error scraping page %s: %s" % ( single_page_url , e ))
-                continue
-
-            if item:
-                yield item
-
-    # Public method called by scraper.py
-    def scrape(self):
-        return self.items(self.urls())
-
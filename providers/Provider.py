@@ -1,4 +1,9 @@
-import re, arrow
+import re, logging, asyncio
+import lxml.html
+from lxml import etree
+from bs4 import UnicodeDammit
+from collections import deque
+from . import fetch, sessions, pipeline, metrics, normalize
 
 class Provider():
 
@@ -7,33 +12,242 @@ class Provider():
     tz = "Europe/Rome"
     language = "it"
 
+    # Max number of single item pages fetched concurrently per source
+    concurrency = 8
+
+    # Parsing backend: "lxml" (fast path) or "bs4" (BeautifulSoup, reference implementation)
+    parser = "lxml"
+
+    # Refresh items of known acts from the data of the index page where the
+    # provider supports it, with a store only (see Halley.py)
+    index_only = False
+
     feed_base_url = "http://feeds.ricostruzionetrasparente.it/albi_pretori/"
     docs_base_url = "http://albopop.it/"
     specs_base_url = "http://albopop.it/specs/"
 
     def __init__(self):
         self.options = {}
+        self.source = None # id column of elenco_albi.csv, set by scraper.py
+        self.store = None # optional ItemStore (providers/store.py), set by scraper.py
+        self.reuse_feed = False # previous feed can be kept if index is unchanged, set by scraper.py
+        self.unchanged = False # index page same as the one of the last complete feed and reuse_feed
+        self.index_digest = None # sha256 of the index page with the HTTP cache, set by get()
+        self.errors = 0 # single item pages that failed in the current scrape
+        self.boost = 0 # extra single item pages fetched concurrently, set by scraper.py when spiders are idle
 
-    # Parse and format datetime strings
+    # Parse and format datetime strings (memoized, see providers/normalize.py)
     def format_datetime(self, ar):
-        if isinstance(ar,arrow.arrow.Arrow):
-            return ar.strftime(self.output_format)
-        elif isinstance(ar,str) and ar:
-            return self.format_datetime(arrow.get(ar,self.input_format).replace(tzinfo=self.tz))
-        else:
-            return ""
+        return normalize.format_datetime(ar, self.input_format, self.tz, self.output_format)
 
     # Clean strings
     def clean_string(self, old_string):
-        if not old_string:
-            return ""
-        new_string = old_string
-        chars = ["\n","\t","\r"]
-        for c in chars:
-            new_string = new_string.replace(c," ")
-        new_string = re.sub(r" {2,}", " ", new_string)
-        return new_string.strip()
-
-    # Public method called by scraper.py
+        return normalize.clean_string(old_string)
+
+    # Clean a list of strings at once
+    def clean_strings(self, old_strings):
+        return normalize.clean_strings(old_strings)
+
+    # Clean the strings of a record and format its date fields at once
+    def normalize_record(self, record, date_fields):
+        return normalize.normalize_record(record, date_fields, self.input_format, self.tz, self.output_format)
+
+    # Per-class cache of compiled resources (XPath expressions, regexes...):
+    # built on first use and shared by all the instances, so by all the
+    # sources, of a provider
+    @classmethod
+    def resource(cls, key, factory):
+        resources = cls.__dict__.get("_resources")
+        if resources is None:
+            resources = cls._resources = {}
+        if key not in resources:
+            resources[key] = factory()
+        return resources[key]
+
+    # Evaluate a compiled XPath expression on an lxml element
+    def xpath(self, element, path):
+        return self.resource(("xpath", path), lambda: etree.XPath(path))(element)
+
+    # Compiled regex
+    def regex(self, pattern):
+        return self.resource(("regex", pattern), lambda: re.compile(pattern))
+
+    # Parse an HTML page with lxml, decoding it as BeautifulSoup does,
+    # so that both parsing backends see the same text
+    def html_tree(self, content):
+        markup = UnicodeDammit(content, is_html = True).unicode_markup
+        try:
+            return lxml.html.document_fromstring(markup)
+        except ValueError:
+            # Unicode strings with an encoding declaration are rejected by lxml
+            return lxml.html.document_fromstring(content)
+
+    # Run a parsing method on fetched content, in the parsers process pool
+    # if enabled (providers/pipeline.py): the method must only depend on
+    # self.options, self.parser and its arguments
+    async def parse(self, method, *args):
+        with metrics.timer("parse"):
+            return await pipeline.run(self, method, *args)
+
+    # Host serving the source, used to schedule sources and limit requests per host
+    # Providers store the index page url in self.options["index_url"] in opts()
+    def host(self):
+        return sessions.host(self.options.get("index_url", ""))
+
+    # Fetch a page through the shared asyncio engine (providers/fetch.py)
+    # Returned object exposes status_code, headers, content and text
+    # Pass index = True for the index page, so that an index unchanged since
+    # the last complete feed of the source can short-circuit the whole scrape()
+    async def get(self, url, headers = None, index = False):
+        if not index:
+            with metrics.timer("fetch"):
+                response = await fetch.get(url, headers)
+            if response.status_code != 200:
+                self.errors += 1
+            return response
+        response = await fetch.get(url, headers)
+        if response.status_code == 200:
+            self.index_digest = response.digest
+        if self.reuse_feed and response.digest and response.digest == fetch.index_completed(self.source):
+            logging.info("Index page %s unchanged since last complete feed" % url)
+            self.unchanged = True
+        return response
+
+    # Scrape index page and yield single item urls (async generator)
+    async def urls(self):
+        return
+        yield
+
+    # Scrape a single item page and return an ItemRecord (providers/records.py) or None
+    async def item(self, single_page_url):
+        return None
+
+    # Simple and generic wrapper around item() method if a list of urls is passed
+    # Accept both lists and async iterables, unavailable items are filtered out
+    # Up to self.concurrency (+ self.boost) pages are fetched at once, items are yielded in urls order
+    # item is the coroutine function building the item of a url, self.item by default
+    async def items(self, single_page_urls, item = None):
+
+        item = item or self.item
+
+        if not hasattr(single_page_urls, "__aiter__"):
+            single_page_urls = self._aiter(single_page_urls)
+
+        pending = deque()
+
+        try:
+
+            async for single_page_url in single_page_urls:
+
+                pending.append(( single_page_url , asyncio.ensure_future(item(single_page_url)) ))
+
+                if len(pending) >= self.concurrency + self.boost:
+                    result = await self._wait_item(*pending.popleft())
+                    if result:
+                        yield result
+
+            while pending:
+                result = await self._wait_item(*pending.popleft())
+                if result:
+                    yield result
+
+        finally:
+            # Consumer stopped early or something failed: drop in-flight pages
+            for single_page_url, task in pending:
+                task.cancel()
+
+    async def _wait_item(self, single_page_url, task):
+        try:
+            return await task
+        except Exception as e:
+            logging.warning("Error scraping page %s: %s" % ( single_page_url , e ))
+            metrics.count("errors")
+            self.errors += 1
+            return None
+
+    async def _aiter(self, iterable):
+        for element in iterable:
+            yield element
+
+    # Wrapper around urls(): stop as soon as the index page is known to be unchanged
+    # Time spent in urls() (index fetch and parsing) is recorded as the index stage
+    async def changed_urls(self):
+        urls = self.urls()
+        while True:
+            with metrics.timer("index"):
+                try:
+                    single_page_url = await urls.__anext__()
+                except StopAsyncIteration:
+                    return
+            if self.unchanged:
+                return
+            yield single_page_url
+
+    # Guid of the item published at single_page_url, known before fetching it
+    def guid(self, single_page_url):
+        return single_page_url
+
+    # Incremental scraping: fetch only pages whose guid is not in the store,
+    # and yield stored and new items as they come in index order, so that a
+    # consumer stopping early (e.g. scraping/feeds.py Budget) keeps them
+    async def stored_items(self):
+
+        known_guids = self.store.guids(self.source)
+        index_guids = []
+        new_items = stored_items = 0
+
+        async def index_urls():
+            async for single_page_url in self.changed_urls():
+                index_guids.append(self.guid(single_page_url))
+                yield single_page_url
+
+        async def stored_or_new(single_page_url):
+            nonlocal new_items, stored_items
+            guid = self.guid(single_page_url)
+            if guid in known_guids:
+                item = self.store.get(self.source, guid)
+                if item:
+                    stored_items += 1
+                    return self.stored_item(guid, item)
+            item = await self.item(single_page_url)
+            if item:
+                self.store.put(self.source, item, commit = False)
+                new_items += 1
+            return item
+
+        try:
+            async for item in self.items(index_urls(), stored_or_new):
+                yield item
+        finally:
+            if self.unchanged:
+                self.store.touch_latest(self.source)
+            else:
+                self.store.touch(self.source, index_guids)
+                logging.info("Source %s: %d new items, %d from store" % ( self.source , new_items , stored_items ))
+
+    # Item of a known act, as stored when its page was scraped
+    # Providers with index-only data (see Halley.py) refresh it from the index page
+    def stored_item(self, guid, item):
+        return item
+
+    # Drop per-scrape state (e.g. index rows not matched by any item),
+    # called when a scrape ends: instances are kept across runs
+    def forget(self):
+        pass
+
+    async def _forgetting(self, items):
+        try:
+            async for item in items:
+                yield item
+        finally:
+            self.forget()
+
+    # Public method called by scraper.py, return an async iterator of items
+    # If self.unchanged is True at the end, no items are yielded and the previous feed is still valid
     def scrape(self):
-        return []
+        self.unchanged = False
+        self.index_digest = None
+        self.errors = 0
+        if self.store is not None and self.source:
+            return self._forgetting(self.stored_items())
+        return self._forgetting(self.items(self.changed_urls()))
@@ -2,10 +2,10 @@
 
 # Mandatory imports
 from .Provider import Provider
-from rfeed import *
+from .records import ItemRecord
 
 # Optional imports
-import requests, mimetypes, logging, re
+import mimetypes, logging
 logging.basicConfig(level=logging.DEBUG)
 from bs4 import BeautifulSoup as bs
 import humanfriendly
@@ -19,15 +19,21 @@ import humanfriendly
 # - feed_base_url
 # - docs_base_url
 # - specs_base_url
+# - concurrency
+# - parser
 # - options
 #
 # Inherited methods:
 # - dt
+# - get: async fetch of a page through the shared engine
+# - items: generic async wrapper around item()
+# - scrape: public method called by scraper.py
 #
 # Specific methods to customize:
 # - opts: using options from csv file properly
-# - urls: extract single item urls from index page
-# - item: extract and structure data from single item page
+# - urls: extract single item urls from index page (async generator)
+# - item: fetch single item page, parse it with parse_page and build the item with page_item
+# - parse_urls / parse_page: parse fetched pages, with self.parser backend (lxml or bs4)
 #
 # WARNING: class name is also the value of provider column in elenco_albi.csv
 #
@@ -40,6 +46,10 @@ class Task(Provider):
     # Optional attributes
     # ...
 
+    def __init__(self):
+        Provider.__init__(self)
+        self.index_rows = {} # rows of the index table by act id, until their item is built
+
     # Transform and prepare options from CSV row (options column)
     def opts(self, opt):
         # From elenco_albi.csv -> options can be read custom options
@@ -48,26 +58,56 @@ class Task(Provider):
         return self # Mandatory for chaining
 
     # Scrape index page and return single item urls
-    def urls(self):
+    async def urls(self):
         # From the index page you have to write here the scraping rules to fetch single page urls
-        # You can return a list of urls (strings) or a generator with the yield operator
+        # This is an async generator: fetch pages with await self.get() and yield urls (strings)
+        # The index page is fetched with index = True to skip unchanged sources
         index_page_url = self.options['index_url']
-        index_page_response = requests.get(index_page_url)
+        index_page_response = await self.get(index_page_url, index = True)
 
         # Manage exceptions and return consistent values
         if index_page_response.status_code != 200:
             logging.warning("Index page %s unavailable!" % index_page_url)
-            return []
+            return
 
-        # Parsing with BeautifulSoup
-        index_page_soup = bs(index_page_response.content,"lxml")
         logging.info("Scraping %s:" % index_page_url)
 
+        for single_page_url in self.parse_urls(index_page_url, index_page_response.content):
+            yield single_page_url
+
+    def parse_urls(self, index_page_url, content):
+
+        if self.parser == "lxml":
+            rows = self.parse_index_lxml(content)
+        else:
+            rows = self.parse_index_bs4(content)
+
+        if rows is None:
+            logging.warning("Table in index page %s not found!" % index_page_url)
+            return
+
+        results, hrefs = rows
+
+        # Kept out of self.options, which is sent with every parsing job
+        self.index_rows = {
+            el["N.Registro"].replace("N.","").strip(): el
+            for el in results
+        }
+
+        for href in hrefs:
+            yield self.clean_string(href)
+
+    # Rows of the index table as dicts and links to single item pages,
+    # None if the table is missing
+    def parse_index_bs4(self, content):
+
+        # Parsing with BeautifulSoup
+        index_page_soup = bs(content,"lxml")
+
         index_table = index_page_soup.find("div", class_="single_post").find("table")
 
         if not index_table:
-            logging.warning("Table in index page %s not found!" % index_page_url)
-            return []
+            return None
 
         headers = [
             self.clean_string(header.text).strip(":")
@@ -82,191 +122,226 @@ class Task(Provider):
             for row in index_table.find_all("tr")[1:]
         ]
 
-        self.options["index_items"] = {
-            el["N.Registro"].replace("N.","").strip(): el
-            for el in results
-        }
+        return results, [a.get("href") for a in index_table.find_all("a") if a.get("href")]
 
-        for a in index_table.find_all("a"):
-            if a.get("href"):
-                yield self.clean_string(a.get("href"))
+    def parse_index_lxml(self, content):
 
-    # Scrape a single item page from its url and return structured data as Item() instance (from rfeed)
-    # Overloaded by Task1 and Task2 methods
-    def item(self,single_page_url):
-        pass
+        index_page_tree = self.html_tree(content)
 
-    # Simple and generic wrapper around item() method if a list of urls is passed
-    # Unavailable items are filtered out
-    def items(self, single_page_urls):
-        # Return value of urls() method is passed to items() method,
-        # so you can manage here the scraping logic if all items are in the index page
-        # and there are no single item pages to fetch
-        for single_page_url in single_page_urls:
-            try:
-                item = self.item(single_page_url)
-                if item:
-                    yield item
-            except Exception as e:
-                logging.warning("Error scraping page %s: %s" % ( single_page_url , e ))
-                continue
-
-    # Public method called by scraper.py
-    def scrape(self):
-        return self.items(self.urls())
+        # Same failure as BeautifulSoup when the div is missing
+        index_post = (self.xpath(index_page_tree, has_class("//div", "single_post")) or [None])[0]
+        index_table = (index_post.xpath(".//table") or [None])[0]
 
-# Custom provider class inherit from the Provider one defined in providers/Provider.py file
-# WARNING: class name is also the value of provider column in elenco_albi.csv
-#
-class Task1(Task):
+        if index_table is None:
+            return None
+
+        table_rows = self.xpath(index_table, ".//tr")
+
+        headers = [
+            self.clean_string(header.text_content()).strip(":")
+            for header in self.xpath(table_rows[0], ".//th")
+        ]
+
+        results = [
+            {
+                headers[i]: self.clean_string(cell.text_content())
+                for i, cell in enumerate(self.xpath(row, ".//td"))
+            }
+            for row in table_rows[1:]
+        ]
+
+        return results, [a.get("href") for a in self.xpath(index_table, ".//a") if a.get("href")]
+
+    # Fetch a single item page from its url, parse it with parse_page() and build its item
+    async def item(self,single_page_url):
 
-    # Scrape a single item page from its url and return structured data as Item() instance (from rfeed)
-    def item(self,single_page_url):
-        # From the url you can fetch the single item page and scrape data from it
-        # You must return an Item() with structured data in it
-        # Refer to Halley.py definition for more details
-        single_page_response = requests.get(single_page_url)
+        single_page_response = await self.get(single_page_url)
 
         if single_page_response.status_code != 200:
             logging.warning("Single page %s unavailable!" % single_page_url)
             return None # None items are dropped in final feed
 
-        single_page_soup = bs(single_page_response.content,"lxml")
         logging.debug("- Scraping %s" % single_page_url)
+        description, id, record, enclosures = await self.parse("parse_page", single_page_response.content)
 
-        single_page_table = single_page_soup.find("div", class_="info")
+        # The index row is dropped as soon as its item is built
+        return self.page_item(single_page_url, description, id, dict(self.index_rows.pop(id, {}), **record), enclosures)
 
-        description = self.clean_string(single_page_table.find("div", class_="etichettalunga").text)
-        id = self.clean_string(re.search("N\. ([^ ]+)", description).group(1))
-        labels = [self.clean_string(cell.text).strip(":") for cell in single_page_table.find_all("div", class_="etichetta")]
-        values = [self.clean_string(cell.text) for cell in single_page_table.find_all("div", class_="valore")]
-        record = dict(zip(labels,values))
+    # Forget index rows left by pages that failed
+    def forget(self):
+        self.index_rows = {}
+
+    # Extract (description, id, record, enclosures) from a single item page,
+    # enclosures as (href, size text or None) tuples
+    def parse_page(self, content):
+        if self.parser == "lxml":
+            return self.parse_page_lxml(content)
+        return self.parse_page_bs4(content)
+
+    # Overloaded by Task1 and Task2 methods, for both parsing backends
+    def parse_page_bs4(self, content):
+        pass
+
+    def parse_page_lxml(self, content):
+        pass
+
+    # Regex extracting the human readable size of an enclosure
+    size_pattern = r"([\d\.]+ ?.B)"
+
+    # Date fields of single item pages and index rows
+    date_fields = ("Esecutiva dal", "Data di pubblicazione", "Dal", "Al")
+
+    # Structure data of a single item page and of its index row as an ItemRecord
+    def page_item(self, single_page_url, description, id, document, enclosures):
 
-        if not self.options["index_items"].get(id):
-            self.options["index_items"][id] = {}
-        self.options["index_items"][id].update(record)
-        document = self.options["index_items"][id]
+        document = self.normalize_record(document, self.date_fields)
 
-        # Return scraping data as an Item() instance
-        return Item(
+        # Return scraping data as an item record (providers/records.py)
+        return ItemRecord(
             title = document["Titolo"],
             link = single_page_url,
             description = description,
-            pubDate = self.format_datetime(document.get("Esecutiva dal") or document.get("Data di pubblicazione") or document.get("Dal")),
-            guid = Guid(single_page_url),
+            pubDate = document.get("Esecutiva dal") or document.get("Data di pubblicazione") or document.get("Dal") or "",
+            guid = single_page_url,
             categories = [
                 c
                 for c in [
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-uid",
-                        category = id
+                    (
+                        self.specs_base_url + "#" + "item-category-uid",
+                        id
                     ),
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-type",
-                        category = document["Tipologia pubblicazione"]
+                    (
+                        self.specs_base_url + "#" + "item-category-type",
+                        document["Tipologia pubblicazione"]
                     ) if document.get("Tipologia pubblicazione") else None,
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-pubStart",
-                        category = self.format_datetime(document.get("Dal") or document.get("Data di pubblicazione") or document.get("Esecutiva dal"))
+                    (
+                        self.specs_base_url + "#" + "item-category-pubStart",
+                        document.get("Dal") or document.get("Data di pubblicazione") or document.get("Esecutiva dal") or ""
                     ),
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-pubEnd",
-                        category = self.format_datetime(document["Al"])
+                    (
+                        self.specs_base_url + "#" + "item-category-pubEnd",
+                        document["Al"]
                     ) if document.get("Al") else None
                 ]
                 if c is not None
             ],
-            enclosure = [
-                Enclosure(
-                    url = enclosure.find("a").get("href"),
-                    length = humanfriendly.parse_size(
-                        re.search(
-                            "([\d\.]+ ?.B)",
-                            self.clean_string(enclosure.find("div", class_="testokb").text)
+            enclosures = [
+                (
+                    href,
+                    humanfriendly.parse_size(
+                        self.regex(self.size_pattern).search(
+                            self.clean_string(size)
                         ).group(1),
                         binary=True
-                    ) if enclosure.find("div", class_="testokb") else 3000,
-                    type = mimetypes.guess_type(enclosure.find("a").get("href"))[0] or "application/octet-stream"
+                    ) if size is not None else 3000,
+                    mimetypes.guess_type(href)[0] or "application/octet-stream"
                 )
-                for enclosure in single_page_soup.find_all("div", class_="testoallegato")
+                for href, size in enclosures
             ]
         )
 
+    # Enclosures of a single item page, shared by Task1 and Task2
+    def enclosures_bs4(self, single_page_soup):
+        return [
+            (
+                enclosure.find("a").get("href"),
+                enclosure.find("div", class_="testokb").text if enclosure.find("div", class_="testokb") else None
+            )
+            for enclosure in single_page_soup.find_all("div", class_="testoallegato")
+        ]
+
+    def enclosures_lxml(self, single_page_tree):
+        enclosures = []
+        for enclosure in self.xpath(single_page_tree, has_class("//div", "testoallegato")):
+            size = self.xpath(enclosure, has_class(".//div", "testokb"))
+            enclosures.append((
+                self.xpath(enclosure, ".//a")[0].get("href"),
+                size[0].text_content() if size else None
+            ))
+        return enclosures
+
+# XPath matching elements with a CSS class, as BeautifulSoup class_ argument
+def has_class(path, css_class):
+    return "%s[contains(concat(' ', normalize-space(@class), ' '), ' %s ')]" % ( path , css_class )
+
+# First text node following element among its siblings, as BeautifulSoup
+# find_next_sibling(string=True): in lxml text nodes are element tails
+def next_text_sibling(element):
+    if element.tail is not None:
+        return element.tail
+    for sibling in element.itersiblings():
+        if sibling.tail is not None:
+            return sibling.tail
+    raise ValueError("header text not found")
+
+# Custom provider class inherit from the Provider one defined in providers/Provider.py file
+# WARNING: class name is also the value of provider column in elenco_albi.csv
+#
+class Task1(Task):
+
+    size_pattern = r"([\d\.]+ ?.B)"
+
+    # Scrape a single item page and return its data
+    def parse_page_bs4(self, content):
+
+        single_page_soup = bs(content,"lxml")
+
+        single_page_table = single_page_soup.find("div", class_="info")
+
+        description = self.clean_string(single_page_table.find("div", class_="etichettalunga").text)
+        id = self.clean_string(self.regex("N\. ([^ ]+)").search(description).group(1))
+        labels = [self.clean_string(cell.text).strip(":") for cell in single_page_table.find_all("div", class_="etichetta")]
+        values = [self.clean_string(cell.text) for cell in single_page_table.find_all("div", class_="valore")]
+
+        return description, id, dict(zip(labels,values)), self.enclosures_bs4(single_page_soup)
+
+    def parse_page_lxml(self, content):
+
+        single_page_tree = self.html_tree(content)
+
+        single_page_table = self.xpath(single_page_tree, has_class("//div", "info"))[0]
+
+        description = self.clean_string(self.xpath(single_page_table, has_class(".//div", "etichettalunga"))[0].text_content())
+        id = self.clean_string(self.regex("N\. ([^ ]+)").search(description).group(1))
+        labels = [label.strip(":") for label in self.clean_strings(cell.text_content() for cell in self.xpath(single_page_table, has_class(".//div", "etichetta")))]
+        values = self.clean_strings(cell.text_content() for cell in self.xpath(single_page_table, has_class(".//div", "valore")))
+
+        return description, id, dict(zip(labels,values)), self.enclosures_lxml(single_page_tree)
+
 # Custom provider class inherit from the Provider one defined in providers/Provider.py file
 # WARNING: class name is also the value of provider column in elenco_albi.csv
 #
 class Task2(Task):
 
-    # Scrape a single item page from its url and return structured data as Item() instance (from rfeed)
-    def item(self,single_page_url):
-        # From the url you can fetch the single item page and scrape data from it
-        # You must return an Item() with structured data in it
-        # Refer to Halley.py definition for more details
-        single_page_response = requests.get(single_page_url)
+    size_pattern = r"([\d\.]+ ?[A-Z]B)"
 
-        if single_page_response.status_code != 200:
-            logging.warning("Single page %s unavailable!" % single_page_url)
-            return None # None items are dropped in final feed
+    # Scrape a single item page and return its data
+    def parse_page_bs4(self, content):
 
-        single_page_soup = bs(single_page_response.content,"lxml")
-        logging.debug("- Scraping %s" % single_page_url)
+        single_page_soup = bs(content,"lxml")
 
         single_page_table = single_page_soup.find("div", class_="info")
 
         header = single_page_soup.find("main", id="main").find("header")
         description = self.clean_string(header.find("h1").text) + " " + self.clean_string(header.find("h1").find_next_sibling(string=True).string or "") + " " + self.clean_string(header.find_next_sibling(string=True).string or "")
-        id = re.search("N\. ([^ ]+)", description).group(1)
+        id = self.regex("N\. ([^ ]+)").search(description).group(1)
         labels = [self.clean_string(cell.text).strip(":") for cell in single_page_table.find_all("td", class_="etichetta")]
         values = [self.clean_string(cell.find_next_sibling("td").text) for cell in single_page_table.find_all("td", class_="etichetta")]
-        record = dict(zip(labels,values))
 
-        if not self.options["index_items"].get(id):
-            self.options["index_items"][id] = {}
-        self.options["index_items"][id].update(record)
-        document = self.options["index_items"][id]
+        return description, id, dict(zip(labels,values)), self.enclosures_bs4(single_page_soup)
 
-        # Return scraping data as an Item() instance
-        return Item(
-            title = document["Titolo"],
-            link = single_page_url,
-            description = description,
-            pubDate = self.format_datetime(document.get("Esecutiva dal") or document.get("Data di pubblicazione") or document.get("Dal")),
-            guid = Guid(single_page_url),
-            categories = [
-                c
-                for c in [
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-uid",
-                        category = id
-                    ),
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-type",
-                        category = document["Tipologia pubblicazione"]
-                    ) if document.get("Tipologia pubblicazione") else None,
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-pubStart",
-                        category = self.format_datetime(document.get("Dal") or document.get("Data di pubblicazione") or document.get("Esecutiva dal"))
-                    ),
-                    Category(
-                        domain = self.specs_base_url + "#" + "item-category-pubEnd",
-                        category = self.format_datetime(document["Al"])
-                    ) if document.get("Al") else None
-                ]
-                if c is not None
-            ],
-            enclosure = [
-                Enclosure(
-                    url = enclosure.find("a").get("href"),
-                    length = humanfriendly.parse_size(
-                        re.search(
-                            "([\d\.]+ ?[A-Z]B)",
-                            self.clean_string(enclosure.find("div", class_="testokb").text)
-                        ).group(1),
-                        binary=True
-                    ) if enclosure.find("div", class_="testokb") else 3000,
-                    type = mimetypes.guess_type(enclosure.find("a").get("href"))[0] or "application/octet-stream"
-                )
-                for enclosure in single_page_soup.find_all("div", class_="testoallegato")
-            ]
-        )
+    def parse_page_lxml(self, content):
+
+        single_page_tree = self.html_tree(content)
+
+        single_page_table = self.xpath(single_page_tree, has_class("//div", "info"))[0]
+
+        header = self.xpath(single_page_tree, "//main[@id='main']//header")[0]
+        h1 = self.xpath(header, ".//h1")[0]
+        description = self.clean_string(h1.text_content()) + " " + self.clean_string(next_text_sibling(h1)) + " " + self.clean_string(next_text_sibling(header))
+        id = self.regex("N\. ([^ ]+)").search(description).group(1)
+        cells = self.xpath(single_page_table, has_class(".//td", "etichetta"))
+        labels = [label.strip(":") for label in self.clean_strings(cell.text_content() for cell in cells)]
+        values = self.clean_strings(next(cell.itersiblings("td")).text_content() for cell in cells)
 
+        return description, id, dict(zip(labels,values)), self.enclosures_lxml(single_page_tree)
@@ -2,10 +2,10 @@
 
 # Mandatory imports
 from .Provider import Provider
-from rfeed import *
+from .records import ItemRecord
 
 # Optional imports
-import requests, mimetypes, logging
+import mimetypes, logging
 logging.basicConfig(level=logging.INFO)
 from bs4 import BeautifulSoup as bs
 
@@ -18,17 +18,24 @@ from bs4 import BeautifulSoup as bs
 # - feed_base_url
 # - docs_base_url
 # - specs_base_url
+# - concurrency
+# - parser
 # - options
 #
 # Inherited methods:
 # - dt
+# - get: async fetch of a page through the shared engine
+# - items: generic async wrapper around item()
+# - scrape: public method called by scraper.py
 #
 # Specific methods to customize:
 # - opts: using options from csv file properly
-# - urls: extract single item urls from index page
+# - urls: extract single item urls from index page (async generator)
 # - item: extract and structure data from single item page
 #
 # WARNING: class name is also the value of provider column in elenco_albi.csv
+# and it is imported on first use from the module with the same name
+# (providers/Name.py, or providers/Task.py for Task1 and Task2), see providers/registry.py
 #
 class Sample(Provider):
 
@@ -43,37 +50,52 @@ class Sample(Provider):
     def opts(self, opt):
         # From elenco_albi.csv -> options can be read custom options
         # Here you can manage them and store in the self.options dict
+        # Store the index page url in self.options["index_url"]: its host is used to schedule requests
         return self # Mandatory for chaining
 
     # Scrape index page and return single item urls
-    def urls(self):
+    async def urls(self):
         # From the index page you have to write here the scraping rules to fetch single page urls
-        # You can return a list of urls (strings) or a generator with the yield operator
-        pass
+        # This is an async generator: fetch pages with await self.get(url) and yield urls (strings)
+        # Fetch the index page with await self.get(url, index = True) to skip unchanged sources
+        return
+        yield
 
-    # Scrape a single item page from its url and return structured data as Item() instance (from rfeed)
-    def item(self,single_page_url):
-        # From the url you can fetch the single item page and scrape data from it
-        # You must return an Item() with structured data in it
-        # Refer to Halley.py definition for more details
-        pass
+    # Scrape a single item page from its url and return structured data as an ItemRecord
+    async def item(self,single_page_url):
+        # From the url you can fetch the single item page (await self.get(url)) and scrape data from it
+        # Parse the page in a parse_item(url, content) method called with
+        # await self.parse("parse_item", url, content): it can run in the parsers process pool
+        single_page_response = await self.get(single_page_url)
+
+        if single_page_response.status_code != 200:
+            logging.warning("Single page %s unavailable!" % single_page_url)
+            return None # None items are dropped in final feed
 
-    # Simple and generic wrapper around item() method if a list of urls is passed
-    # Unavailable items are filtered out
-    def items(self, single_page_urls):
-        # Return value of urls() method is passed to items() method,
-        # so you can manage here the scraping logic if all items are in the index page
-        # and there are no single item pages to fetch
-        for single_page_url in single_page_urls:
-            try:
-                item = self.item(single_page_url)
-                if item:
-                    yield item
-            except Exception as e:
-                logging.warning("Error scraping page %s: %s" % ( single_page_url , e ))
-                continue
+        return await self.parse("parse_item", single_page_url, single_page_response.content)
 
-    # Public method called by scraper.py
-    def scrape(self):
-        return self.items(self.urls())
+    # Structure data of a single item page as an ItemRecord
+    def parse_item(self, single_page_url, content):
+        # You must return an ItemRecord with structured data in it: strings,
+        # categories as (domain, category) and enclosures as (url, length, type) tuples
+        # Refer to Halley.py definition for more details
+        single_page_soup = bs(content,"lxml")
+        title = self.clean_string(single_page_soup.find("h1").text)
+        return ItemRecord(
+            title = title,
+            link = single_page_url,
+            description = title,
+            pubDate = self.format_datetime(self.clean_string(single_page_soup.find("time").text)),
+            guid = single_page_url,
+            categories = [
+                ( self.specs_base_url + "#" + "item-category-uid" , single_page_url )
+            ],
+            enclosures = [
+                ( a["href"] , 3000 , mimetypes.guess_type(a["href"])[0] or "application/octet-stream" )
+                for a in single_page_soup.find_all("a", href = True)
+            ]
+        )
 
+    # Generic items() and scrape() are inherited from Provider:
+    # override items() only if all items are in the index page
+    # and there are no single item pages to fetch
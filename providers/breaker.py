@@ -0,0 +1,77 @@
+# Circuit breaker of remote hosts, persisted across runs (JSON file)
+#
+# A host failing max_failures requests in a row (connection errors, timeouts
+# and 5xx responses, after retries) is opened: its requests fail at once
+# with HostUnavailable instead of waiting on a dead server. After cooldown
+# seconds a single probe request is let through (half open): if it succeeds
+# the host is closed again, otherwise it stays open for twice the previous
+# cooldown, up to max_cooldown.
+# The state is saved on every transition, so the next run (or another
+# process started later) skips hosts known to be down.
+
+import os, json, time, logging
+from .files import atomic_write
+
+class HostUnavailable(Exception):
+    pass
+
+class CircuitBreaker():
+
+    def __init__(self, path, max_failures = 5, cooldown = 600, max_cooldown = 86400):
+        self.path = path
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probing = set()
+        self.hosts = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.hosts = json.load(f)
+            except ValueError as e:
+                logging.warning("Ignoring broken circuit breaker state %s: %s" % ( path , e ))
+
+    def _host(self, host):
+        return self.hosts.setdefault(host, {"failures": 0, "opened": None, "cooldown": self.cooldown})
+
+    def is_open(self, host):
+        state = self.hosts.get(host)
+        return bool(state and state["opened"] is not None)
+
+    # Raise HostUnavailable if requests to host must not be sent now
+    def check(self, host):
+        state = self.hosts.get(host)
+        if not state or state["opened"] is None:
+            return
+        if time.time() < state["opened"] + state["cooldown"] or host in self.probing:
+            raise HostUnavailable("Host %s unavailable (circuit open)" % host)
+        logging.info("Probing host %s" % host)
+        self.probing.add(host)
+
+    def success(self, host):
+        self.probing.discard(host)
+        state = self.hosts.get(host)
+        if not state or (state["failures"] == 0 and state["opened"] is None):
+            return
+        if state["opened"] is not None:
+            logging.info("Host %s is back, circuit closed" % host)
+        del self.hosts[host]
+        self.save()
+
+    def failure(self, host):
+        state = self._host(host)
+        state["failures"] += 1
+        if host in self.probing:
+            self.probing.discard(host)
+            state["cooldown"] = min(self.max_cooldown, state["cooldown"] * 2)
+            state["opened"] = time.time()
+            logging.warning("Host %s still failing, circuit open for %d s" % ( host , state["cooldown"] ))
+            self.save()
+        elif state["opened"] is None and state["failures"] >= self.max_failures:
+            state["opened"] = time.time()
+            logging.warning("Host %s failed %d times, circuit open for %d s" % ( host , state["failures"] , state["cooldown"] ))
+            self.save()
+
+    def save(self):
+        with atomic_write(self.path) as f:
+            json.dump(self.hosts, f, indent = 1, sort_keys = True)
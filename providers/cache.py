@@ -0,0 +1,84 @@
+# On-disk HTTP cache with conditional requests
+#
+# For every cached url two files are kept in the cache directory:
+# <sha1 of url>.json with validators (ETag, Last-Modified), the sha256 of
+# the body and a few response attributes, and <sha1 of url>.body with the
+# raw content. Cached validators are sent as If-None-Match and
+# If-Modified-Since, a 304 response is served from disk. Servers without
+# validators always send the full page: in that case the content hash tells
+# whether the page changed since the previous run.
+#
+# An unchanged index page alone does not mean the feed of its source is
+# complete: pages may have failed, or the run may have been cut short. The
+# digest of the index page a feed was fully built from is kept per source
+# in <sha1 of source:id>.index (complete()), and only an index matching it
+# can short-circuit the next scrape (completed()). forget() drops it before
+# a feed is replaced, and when a feed is partial or failed.
+
+import os, json, hashlib, logging
+from .files import atomic_write
+
+class HttpCache():
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+
+    def _filename(self, url, extension):
+        return os.path.join(self.path, hashlib.sha1(url.encode("utf-8")).hexdigest() + extension)
+
+    # Cached metadata of url, None if never seen
+    def load(self, url):
+        try:
+            with open(self._filename(url, ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def body(self, url):
+        with open(self._filename(url, ".body"), "rb") as f:
+            return f.read()
+
+    # Conditional request headers for url
+    def validators(self, url, meta = None):
+        meta = meta or self.load(url) or {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def save(self, url, response, digest):
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_type": response.headers.get("Content-Type"),
+            "encoding": response.encoding,
+            "sha256": digest
+        }
+        # The body is replaced first, a meta file never points at a partial body
+        with atomic_write(self._filename(url, ".body"), "wb") as f:
+            f.write(response.content)
+        with atomic_write(self._filename(url, ".json")) as f:
+            json.dump(meta, f)
+        logging.debug("Cached %s" % url)
+
+    # Digest of the index page of the last complete feed of source, None if unknown
+    def completed(self, source):
+        try:
+            with open(self._filename("source:" + source, ".index")) as f:
+                return json.load(f)["sha256"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def complete(self, source, digest):
+        with atomic_write(self._filename("source:" + source, ".index")) as f:
+            json.dump({"source": source, "sha256": digest}, f)
+
+    def forget(self, source):
+        try:
+            os.remove(self._filename("source:" + source, ".index"))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,112 @@
+# Record and replay of HTTP responses, for offline provider development
+#
+# A cassette holds every response fetched while scraping one source (a CSV
+# row). While a cassette is in use (with Cassette(path, mode): ...) every
+# request of the current task and of the tasks it starts goes through it:
+# - "record": requests go to the network as usual and responses are kept,
+#   the cassette file is written when the block ends
+# - "replay": responses are served from the cassette, nothing is sent on
+#   the network and missing requests fail with CassetteMiss
+#
+# File format: a magic line, the zlib-compressed bodies one after the other,
+# a zlib-compressed JSON index ("METHOD url" -> status, headers, encoding,
+# offset and length of the body) and a trailer with the index offset and
+# length. On replay the file is memory-mapped and only the bodies that are
+# requested get decompressed.
+
+import os, json, mmap, zlib, struct, logging
+from contextvars import ContextVar
+import aiohttp
+from multidict import CIMultiDict
+from .files import atomic_write
+
+MAGIC = b"RTCASSETTE1\n"
+TRAILER = struct.Struct("<QQ")
+
+current = ContextVar("current_cassette", default = None)
+
+class CassetteMiss(aiohttp.ClientConnectionError):
+    pass
+
+class Cassette():
+
+    def __init__(self, path, mode = "replay"):
+        if mode not in ("record", "replay"):
+            raise ValueError("Cassette mode must be record or replay: %s" % mode)
+        self.path = path
+        self.mode = mode
+        self.index = {}
+        self.bodies = []
+        self.size = 0
+        self.map = None
+        self.token = None
+        if mode == "replay":
+            self.load()
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def __enter__(self):
+        self.token = current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        current.reset(self.token)
+        if self.mode == "record":
+            self.save()
+        self.close()
+
+    # A missing cassette replays nothing: all its requests miss
+    def load(self):
+        if not os.path.exists(self.path):
+            logging.warning("No cassette %s" % self.path)
+            return
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a cassette: %s" % self.path)
+        offset, length = TRAILER.unpack(self.map[-TRAILER.size:])
+        self.index = json.loads(zlib.decompress(self.map[offset:offset + length]))
+
+    # Keep a response (providers/fetch.py Response) of a request
+    def record(self, method, url, response):
+        body = zlib.compress(response.content)
+        self.index["%s %s" % ( method , url )] = {
+            "url": response.url,
+            "status": response.status_code,
+            "headers": list(response.headers.items()),
+            "encoding": response.encoding,
+            "offset": len(MAGIC) + self.size,
+            "length": len(body)
+        }
+        self.bodies.append(body)
+        self.size += len(body)
+
+    # Recorded response of a request, as a providers/fetch.py Response
+    def replay(self, method, url, response_class):
+        entry = self.index.get("%s %s" % ( method , url ))
+        if entry is None:
+            raise CassetteMiss("%s %s not in cassette %s" % ( method , url , self.path ))
+        content = zlib.decompress(self.map[entry["offset"]:entry["offset"] + entry["length"]])
+        return response_class(entry["url"], entry["status"], CIMultiDict(entry["headers"]), content, entry["encoding"])
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+        index = zlib.compress(json.dumps(self.index, sort_keys = True).encode("utf-8"))
+        with atomic_write(self.path, "wb") as f:
+            f.write(MAGIC)
+            for body in self.bodies:
+                f.write(body)
+            f.write(index)
+            f.write(TRAILER.pack(len(MAGIC) + self.size, len(index)))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.bodies = []
+
+# Cassette of a source in directory, for mode
+def for_source(directory, source, mode):
+    return Cassette(os.path.join(directory, "%s.cassette" % source), mode)
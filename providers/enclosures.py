@@ -0,0 +1,146 @@
+# Background resolution of enclosure sizes and MIME types (SQLite cache)
+#
+# Providers cannot know the size of most attachments without downloading
+# them (Halley writes 3000 for all of them). The resolver asks the servers:
+# a HEAD request, or a GET of the first byte (Range: bytes=0-0) when HEAD is
+# refused or has no Content-Length, without downloading bodies.
+# Results are cached by url for good, failures are retried after retry_days.
+#
+# Resolution never blocks feed output: items(items) fills enclosures with
+# the cached values when known and hands the other urls to a few background
+# workers, so new attachments get their real size in the next feed.
+# Checks are background requests (providers/fetch.py): attachments are often
+# on the host of the albo itself, and their checks must neither slow down
+# its scraping nor open its circuit.
+
+import re, time, asyncio, sqlite3, logging
+from . import fetch, metrics, cassettes
+
+CONTENT_RANGE = re.compile(r"/\s*(\d+)\s*$")
+GENERIC_TYPES = ("", "application/octet-stream", "text/html", "text/plain")
+
+class EnclosureResolver():
+
+    def __init__(self, path, workers = 4, retry_days = 7, batch_size = 50):
+        self.path = path
+        self.workers = workers
+        self.retry_days = retry_days
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS enclosures (
+                url TEXT PRIMARY KEY,
+                length INTEGER,
+                type TEXT,
+                checked INTEGER NOT NULL
+            )
+        """)
+        self.db.commit()
+        self.queue = None
+        self.pending = set()
+        self.results = []
+        self.tasks = []
+        self.resolved = self.failed = 0
+
+    # Cached (length, type, checked) of url, None if never checked
+    # length is None if the check failed
+    def lookup(self, url):
+        row = self.db.execute("SELECT length, type, checked FROM enclosures WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2]
+
+    # Queue url for resolution, unless cached or already queued
+    def submit(self, url, cached = None):
+        if url in self.pending or not url.startswith("http"):
+            return
+        if cached and (cached[0] is not None or cached[2] > time.time() - self.retry_days * 86400):
+            return
+        self.start()
+        self.pending.add(url)
+        self.queue.put_nowait(url)
+
+    # Pass items through, with known enclosure sizes and types
+    async def items(self, items):
+        async for item in items:
+            if item.enclosures:
+                item.enclosures = tuple(self.enclosure(*enclosure) for enclosure in item.enclosures)
+            yield item
+
+    # (url, length, type) of an enclosure, with the cached size and type if known
+    def enclosure(self, url, length, type):
+        cached = self.lookup(url)
+        if cached and cached[0] is not None:
+            return url, cached[0], cached[1] if cached[1] and cached[1] not in GENERIC_TYPES else type
+        self.submit(url, cached)
+        return url, length, type
+
+    # Size and type of url from response headers, None if unknown
+    async def resolve(self, url):
+
+        response = await fetch.request("HEAD", url, read = False, background = True)
+        length = response.headers.get("Content-Length") if response.status_code == 200 else None
+
+        if length is None:
+            response = await fetch.request("GET", url, {"Range": "bytes=0-0"}, read = False, background = True)
+            if response.status_code == 206:
+                match = CONTENT_RANGE.search(response.headers.get("Content-Range", ""))
+                length = match.group(1) if match else None
+            elif response.status_code == 200:
+                length = response.headers.get("Content-Length")
+
+        if length is None or not length.isdigit():
+            return None, None
+
+        return int(length), response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+
+    async def worker(self):
+        while True:
+            url = await self.queue.get()
+            try:
+                length, type = await self.resolve(url)
+            except Exception as e:
+                logging.debug("Enclosure %s not resolved: %s" % ( url , e ))
+                length, type = None, None
+            finally:
+                self.pending.discard(url)
+                self.queue.task_done()
+            if length is None:
+                self.failed += 1
+            else:
+                self.resolved += 1
+            self.results.append((url, length, type, int(time.time())))
+            if len(self.results) >= self.batch_size or self.queue.empty():
+                self.save()
+
+    # Workers are started on the first url to resolve, outside of any source
+    # (and of its cassette)
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            context = metrics.current_source.set(None)
+            cassette = cassettes.current.set(None)
+            self.tasks = [asyncio.ensure_future(self.worker()) for n in range(self.workers)]
+            cassettes.current.reset(cassette)
+            metrics.current_source.reset(context)
+
+    def save(self):
+        if self.results:
+            self.db.executemany("INSERT OR REPLACE INTO enclosures (url, length, type, checked) VALUES (?, ?, ?, ?)", self.results)
+            self.db.commit()
+            self.results = []
+
+    # Keep resolving queued urls for up to timeout seconds, then stop:
+    # urls left are queued again by the next run
+    async def close(self, timeout = 0):
+        if self.queue is not None and timeout:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions = True)
+        self.save()
+        logging.info("Enclosures %s: %d resolved, %d failed, %d left for the next run" % ( self.path , self.resolved , self.failed , len(self.pending) ))
+        self.db.close()
@@ -0,0 +1,211 @@
+# Shared asyncio fetch engine used by all providers
+#
+# Providers never call an HTTP library directly: they await Provider.get(),
+# which ends up here. Requests go through the per-host pooled sessions of
+# providers/sessions.py, each host has its own concurrency and rate limits
+# (providers/politeness.py) and a global semaphore caps how many requests
+# are waiting on remote servers at the same time. GET requests can be served
+# through an on-disk HttpCache (providers/cache.py).
+# Every request has a timeout (providers/sessions.py), transient errors are
+# retried with jittered exponential backoff and hosts that keep failing are
+# skipped by an optional CircuitBreaker (providers/breaker.py).
+# Inside a cassette (providers/cassettes.py) responses are recorded, or
+# replayed without any network access.
+
+import asyncio, logging, hashlib, random, time
+import aiohttp
+from . import sessions, politeness
+from .cache import HttpCache
+from .breaker import CircuitBreaker, HostUnavailable
+from . import cassettes
+
+# Max number of concurrent requests on the event loop (see configure())
+max_in_flight = 200
+
+# Optional HttpCache for GET requests (see configure())
+cache = None
+
+# Optional CircuitBreaker of hosts (see configure())
+breaker = None
+
+# Callables notified after every attempt with (method, url, status, size, elapsed),
+# status is None when the connection failed
+observers = []
+
+_semaphore = None
+
+# Minimal response object, modeled on requests.Response so that providers
+# can keep using status_code, content and text as before
+# not_modified is True when the page is unchanged since the previous run,
+# digest is the sha256 of the content of cached pages
+class Response():
+
+    def __init__(self, url, status_code, headers, content, encoding = None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or "utf-8"
+        self.not_modified = False
+        self.digest = None
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors = "replace")
+
+# Change engine settings, must be called before the first request
+def configure(max_requests = None, cache_dir = None, breaker_path = None, breaker_failures = 5, breaker_cooldown = 600):
+    global max_in_flight, cache, breaker
+    if max_requests:
+        max_in_flight = max_requests
+    if cache_dir:
+        cache = HttpCache(cache_dir)
+    if breaker_path:
+        breaker = CircuitBreaker(breaker_path, max_failures = breaker_failures, cooldown = breaker_cooldown)
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max_in_flight)
+    return _semaphore
+
+async def _request(method, url, headers, read = True):
+    async with sessions.session(url).request(method, url, headers = headers) as response:
+        if read:
+            content = await response.read()
+        else:
+            # Headers only: the body is not downloaded, the connection is dropped
+            content = b""
+            response.close()
+        logging.debug("%s %s -> %d (%d bytes)" % ( method , url , response.status , len(content) ))
+        return Response(
+            str(response.url),
+            response.status,
+            response.headers,
+            content,
+            response.charset
+        )
+
+def _notify(*event):
+    for observer in observers:
+        observer(*event)
+
+# Seconds to wait before a retry: exponential backoff with full jitter, so
+# that requests failing together do not retry together
+def backoff(attempt):
+    return random.uniform(0, min(sessions.max_backoff, sessions.backoff * 2 ** (attempt - 1)))
+
+# Perform a request and return a Response with the whole body read,
+# or with headers only (empty content) if read is False
+# Connection errors, timeouts and sessions.retry_statuses are retried
+# sessions.retries times, raise breaker.HostUnavailable if the host is skipped
+# Background requests have their own per-host limits (politeness.background_limiter)
+# and their outcome is not reported to the circuit breaker
+async def request(method, url, headers = None, read = True, background = False):
+    cassette = cassettes.current.get()
+    if cassette is not None and cassette.replaying:
+        return cassette.replay(method, url, Response)
+    if background:
+        response = await _background_request(method, url, headers, read)
+    else:
+        response = await _breaker_request(method, url, headers, read)
+    if cassette is not None:
+        cassette.record(method, url, response)
+    return response
+
+async def _breaker_request(method, url, headers, read):
+    host = sessions.host(url)
+    if breaker:
+        breaker.check(host)
+    try:
+        response = await _retry(host, method, url, headers, read)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        if breaker:
+            breaker.failure(host)
+        raise
+    except BaseException:
+        if breaker:
+            breaker.probing.discard(host)
+        raise
+    if breaker:
+        if response.status_code >= 500:
+            breaker.failure(host)
+        else:
+            breaker.success(host)
+    return response
+
+# Hosts with open circuit are skipped, but never probed
+async def _background_request(method, url, headers, read):
+    host = sessions.host(url)
+    if breaker and breaker.is_open(host):
+        raise HostUnavailable("Host %s unavailable (circuit open)" % host)
+    return await _retry(host, method, url, headers, read, politeness.background_limiter(host))
+
+async def _retry(host, method, url, headers, read, limiter = None):
+    async with limiter or politeness.limiter(host), _get_semaphore():
+        for attempt in range(sessions.retries + 1):
+            if attempt:
+                sessions.count(host, "retries")
+                await asyncio.sleep(backoff(attempt))
+            sessions.count(host, "requests")
+            start = time.perf_counter()
+            try:
+                response = await _request(method, url, headers, read)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                _notify(method, url, None, 0, time.perf_counter() - start)
+                if attempt < sessions.retries:
+                    logging.debug("%s %s failed (%s), retrying" % ( method , url , type(e).__name__ ))
+                    continue
+                raise
+            _notify(method, url, response.status_code, len(response.content), time.perf_counter() - start)
+            if response.status_code in sessions.retry_statuses and attempt < sessions.retries:
+                continue
+            return response
+
+async def get(url, headers = None):
+
+    if cache is None:
+        return await request("GET", url, headers)
+
+    # Cassettes record full responses: a 304 would not replay without this cache
+    meta = cache.load(url)
+    cassette = cassettes.current.get()
+    recording = cassette is not None and not cassette.replaying
+    response = await request("GET", url, dict(headers or {}, **({} if recording else cache.validators(url, meta))))
+
+    if response.status_code == 304 and meta:
+        response = Response(url, 200, {"Content-Type": meta["content_type"] or ""}, cache.body(url), meta["encoding"])
+        response.not_modified = True
+        response.digest = meta["sha256"]
+    elif response.status_code == 200:
+        digest = hashlib.sha256(response.content).hexdigest()
+        response.not_modified = meta is not None and meta["sha256"] == digest
+        cache.save(url, response, digest)
+        response.digest = digest
+
+    return response
+
+# Digest of the index page the last complete feed of source was built from,
+# None without cache or if the feed is not known to be complete
+def index_completed(source):
+    return cache.completed(source) if cache and source else None
+
+# The feed of source was fully built from the index page with this digest
+def complete_index(source, digest):
+    if cache and source and digest:
+        cache.complete(source, digest)
+
+# The feed of source is being replaced, is partial or failed: its index
+# page cannot short-circuit the next scrape
+def forget_index(source):
+    if cache and source:
+        cache.forget(source)
+
+# Release pooled connections at the end of a run
+async def close():
+    global _semaphore
+    if breaker:
+        breaker.save()
+    await sessions.close()
+    politeness.reset()
+    _semaphore = None
@@ -0,0 +1,29 @@
+# Atomic file writes
+#
+# Content is written to a temporary file next to the final one, which is
+# replaced only once the temporary file is complete: readers (and the next
+# run, after a crash) see either the previous file or the new one. If
+# writing fails, the temporary file is removed.
+
+import os, tempfile
+from contextlib import contextmanager
+
+# with atomic_write(path) as f: f.write(...)
+# mode is "w" or "wb", permissions (e.g. 0o644) are applied before the replacement,
+# files are otherwise private as created by tempfile
+@contextmanager
+def atomic_write(path, mode = "w", permissions = None):
+    directory = os.path.dirname(os.path.abspath(path))
+    f = tempfile.NamedTemporaryFile(mode, dir = directory, prefix = ".", suffix = ".tmp", delete = False)
+    try:
+        with f:
+            yield f
+        if permissions is not None:
+            os.chmod(f.name, permissions)
+        os.replace(f.name, path)
+    except BaseException:
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+        raise
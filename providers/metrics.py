@@ -0,0 +1,185 @@
+# Per-source counters and per-stage timings of a run
+#
+# The source being scraped is tracked with a context variable: scraper.py
+# sets it when a source starts, and every task spawned while scraping it
+# (single item pages, parsing jobs) inherits it, so requests and stages are
+# attributed to the right source even with many sources in flight.
+#
+# Counters: requests, bytes, errors (failed requests and dropped pages), items.
+# Stages: index (index page fetch), fetch (single item pages), parse,
+# feed (serialization) and write (comparison and replacement of the file).
+# Stage timings are summed over concurrent operations, so they can exceed the
+# source wall-clock duration.
+# Memory: resident set size of the process when a source starts and its
+# peak while the source runs (sampled when stage operations end, at most
+# every 50 ms).
+# RSS is process-wide: with many sources in flight, compare the growth
+# (peak_rss - start_rss) of sources rather than their peaks.
+
+import os, json, time, resource
+from contextlib import contextmanager
+from contextvars import ContextVar
+from .files import atomic_write
+
+COUNTERS = ("requests", "bytes", "errors", "items")
+STAGES = ("index", "fetch", "parse", "feed", "write")
+
+current_source = ContextVar("current_source", default = None)
+
+started = time.time()
+_sources = {}
+
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_rss = ( 0.0 , 0 ) # time and value of the last RSS sample
+
+# Current resident set size of the process in bytes (peak RSS where /proc is missing)
+def rss():
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _page_size
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# RSS sampled at most every interval seconds: stages end very often
+def _recent_rss(interval = 0.05):
+    global _rss
+    now = time.monotonic()
+    if now - _rss[0] >= interval:
+        _rss = ( now , rss() )
+    return _rss[1]
+
+def _record(source):
+    if source not in _sources:
+        _sources[source] = {
+            "provider": None,
+            "status": None,
+            "duration": 0.0,
+            "start_rss": 0,
+            "peak_rss": 0,
+            "counters": dict.fromkeys(COUNTERS, 0),
+            "stages": dict.fromkeys(STAGES, 0.0)
+        }
+    return _sources[source]
+
+# Attribute everything that follows in the current task (and its children) to source
+def start(source, provider = None):
+    record = _record(source)
+    record["provider"] = provider
+    record["start_rss"] = record["peak_rss"] = rss()
+    current_source.set(source)
+
+def finish(source, status, duration):
+    record = _record(source)
+    record["status"] = status
+    record["duration"] = duration
+    _sample(record)
+
+def _sample(record):
+    current = _recent_rss()
+    if current > record["peak_rss"]:
+        record["peak_rss"] = current
+
+def count(counter, value = 1, source = None):
+    source = source or current_source.get()
+    if source:
+        _record(source)["counters"][counter] += value
+
+@contextmanager
+def timer(stage):
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        source = current_source.get()
+        if source:
+            record = _record(source)
+            record["stages"][stage] += time.perf_counter() - begin
+            _sample(record)
+
+# Observer for providers/fetch.py
+def observe(method, url, status, size, elapsed):
+    count("requests")
+    count("bytes", size)
+    if status is None or status >= 400:
+        count("errors")
+
+def summary():
+    totals = {
+        "counters": dict.fromkeys(COUNTERS, 0),
+        "stages": dict.fromkeys(STAGES, 0.0)
+    }
+    for record in _sources.values():
+        for group in ("counters", "stages"):
+            for name, value in record[group].items():
+                totals[group][name] += value
+    return {
+        "started": started,
+        "duration": time.time() - started,
+        "totals": totals,
+        "sources": _sources
+    }
+
+# Slowest sources as (source, duration) tuples
+def slowest(n = 5):
+    return sorted(((s, r["duration"]) for s, r in _sources.items()), key = lambda s: -s[1])[:n]
+
+# Sources with the largest RSS growth as (source, peak RSS, growth) tuples, in bytes
+def largest(n = 5):
+    growth = ((s, r["peak_rss"], r["peak_rss"] - r["start_rss"]) for s, r in _sources.items())
+    return sorted(growth, key = lambda s: -s[2])[:n]
+
+def _write_atomic(path, content):
+    with atomic_write(path, permissions = 0o644) as f:
+        f.write(content)
+
+def write_json(path):
+    _write_atomic(path, json.dumps(summary(), indent = 1, sort_keys = True))
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Prometheus textfile collector format (node_exporter --collector.textfile)
+def write_prometheus(path, prefix = "rt_scraper"):
+
+    s = summary()
+    lines = [
+        "# HELP %s_run_timestamp_seconds Start time of the last run." % prefix,
+        "# TYPE %s_run_timestamp_seconds gauge" % prefix,
+        "%s_run_timestamp_seconds %f" % ( prefix , s["started"] ),
+        "# HELP %s_run_duration_seconds Duration of the last run." % prefix,
+        "# TYPE %s_run_duration_seconds gauge" % prefix,
+        "%s_run_duration_seconds %f" % ( prefix , s["duration"] ),
+        "# HELP %s_source_duration_seconds Wall-clock duration of a source." % prefix,
+        "# TYPE %s_source_duration_seconds gauge" % prefix
+    ]
+
+    for source, record in sorted(s["sources"].items()):
+        lines.append('%s_source_duration_seconds{source="%s",provider="%s",status="%s"} %f' % (
+            prefix, _label(source), _label(record["provider"]), _label(record["status"]), record["duration"]
+        ))
+
+    for name, help in (( "peak_rss" , "Peak resident set size of the process while a source ran." ), ( "start_rss" , "Resident set size of the process when a source started." )):
+        lines.append("# HELP %s_source_%s_bytes %s" % ( prefix , name , help ))
+        lines.append("# TYPE %s_source_%s_bytes gauge" % ( prefix , name ))
+        for source, record in sorted(s["sources"].items()):
+            lines.append('%s_source_%s_bytes{source="%s",provider="%s"} %d' % (
+                prefix, name, _label(source), _label(record["provider"]), record[name]
+            ))
+
+    for counter in COUNTERS:
+        lines.append("# HELP %s_source_%s Number of %s of a source in the last run." % ( prefix , counter , counter ))
+        lines.append("# TYPE %s_source_%s gauge" % ( prefix , counter ))
+        for source, record in sorted(s["sources"].items()):
+            lines.append('%s_source_%s{source="%s",provider="%s"} %d' % (
+                prefix, counter, _label(source), _label(record["provider"]), record["counters"][counter]
+            ))
+
+    lines.append("# HELP %s_source_stage_seconds Time spent by a source in a stage, summed over concurrent operations." % prefix)
+    lines.append("# TYPE %s_source_stage_seconds gauge" % prefix)
+    for source, record in sorted(s["sources"].items()):
+        for stage in STAGES:
+            lines.append('%s_source_stage_seconds{source="%s",provider="%s",stage="%s"} %f' % (
+                prefix, _label(source), _label(record["provider"]), stage, record["stages"][stage]
+            ))
+
+    _write_atomic(path, "\n".join(lines) + "\n")
@@ -0,0 +1,98 @@
+# Shared date and text normalization used by Provider
+#
+# The same few dates repeat across hundreds of items of an albo, so
+# formatted dates are memoized in a bounded LRU cache keyed on
+# (string, input format, timezone, output format). Plain day/month/year
+# formats are parsed with a precompiled regex instead of arrow, and any
+# string the fast path does not fully match goes through arrow.get(), so
+# results (and errors) are the same as before.
+# Strings are cleaned with a single precompiled whitespace regex.
+# normalize_record() cleans and formats all the fields of a record at once.
+
+import re, arrow, logging
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+WHITESPACE = re.compile(r"[ \t\n\r]+")
+
+# Fast path regexes for arrow formats made only of day, month and year tokens
+TOKENS = {
+    "DD": r"(?P<day>\d{2})",
+    "D": r"(?P<day>\d{1,2})",
+    "MM": r"(?P<month>\d{2})",
+    "M": r"(?P<month>\d{1,2})",
+    "YYYY": r"(?P<year>\d{4})"
+}
+FORMAT_TOKENS = re.compile(r"YYYY|DD|D|MM|M|[^YDM]+|.")
+
+@lru_cache(maxsize = 64)
+def _fast_pattern(input_format):
+    pattern = ""
+    for token in FORMAT_TOKENS.findall(input_format):
+        if token in TOKENS:
+            pattern += TOKENS[token]
+        elif token[0] in "YDM" or any(c.isalpha() for c in token):
+            return None # other arrow tokens: no fast path
+        else:
+            pattern += re.escape(token)
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return None # repeated tokens
+
+@lru_cache(maxsize = 64)
+def _zone(tz):
+    return ZoneInfo(tz)
+
+@lru_cache(maxsize = 4096)
+def format_date_string(value, input_format, tz, output_format):
+
+    pattern = _fast_pattern(input_format)
+    match = pattern.fullmatch(value) if pattern else None
+
+    if match:
+        try:
+            return datetime(
+                int(match.group("year")),
+                int(match.group("month")),
+                int(match.group("day")),
+                tzinfo = _zone(tz)
+            ).strftime(output_format)
+        except (ValueError, IndexError, KeyError):
+            pass # let arrow raise its own error
+
+    return arrow.get(value, input_format).replace(tzinfo = tz).strftime(output_format)
+
+# Same contract as Provider.format_datetime: Arrow instances or strings, "" otherwise
+def format_datetime(value, input_format, tz, output_format):
+    if isinstance(value, arrow.arrow.Arrow):
+        return value.strftime(output_format)
+    elif isinstance(value, str) and value:
+        return format_date_string(value, input_format, tz, output_format)
+    else:
+        return ""
+
+def clean_string(value):
+    if not value:
+        return ""
+    return WHITESPACE.sub(" ", value).strip()
+
+# Batch API: clean every value of a list at once
+def clean_strings(values):
+    return [clean_string(value) for value in values]
+
+# Batch API for a record (field name -> value): string values are cleaned
+# and date fields formatted, other values are kept as they are
+# Missing date fields are skipped and invalid ones dropped, so that
+# providers fall back to other fields as if they were missing
+def normalize_record(record, date_fields, input_format, tz, output_format):
+    result = {key: clean_string(value) if isinstance(value, str) else value for key, value in record.items()}
+    for field in date_fields:
+        if result.get(field):
+            try:
+                result[field] = format_date_string(result[field], input_format, tz, output_format)
+            except ValueError as e:
+                logging.debug("Invalid date %s %r: %s" % ( field , result[field] , e ))
+                del result[field]
+    return result
@@ -0,0 +1,68 @@
+# Optional process pool for the parsing stage of providers
+#
+# Fetching stays on the asyncio event loop, while the CPU-bound parsing of
+# fetched pages (parse_item) can be handed to a pool of worker processes,
+# so it is not serialized by the GIL. Each job carries the provider class,
+# its options and the raw page bytes: the worker rebuilds the provider and
+# returns the parsed item. At most max_pending pages can wait for a parser,
+# fetchers holding a page beyond that wait for a free slot, which keeps
+# memory bounded when parsers are the bottleneck.
+
+import asyncio, importlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+workers = 0         # number of parser processes, 0 to parse in the event loop
+max_pending = 0     # pages queued or being parsed, defaults to 2 * workers
+
+_executor = None
+_slots = None
+
+def configure(workers = None, max_pending = None):
+    module = globals()
+    for name, value in (( "workers" , workers ), ( "max_pending" , max_pending )):
+        if value is not None:
+            module[name] = value
+
+# Start the pool, must be called before the event loop (and its threads) starts:
+# workers are forked once and reused for the whole run
+def start():
+    global _executor
+    if workers and _executor is None:
+        _executor = ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("fork"))
+        list(_executor.map(int, range(workers)))
+
+def shutdown():
+    global _executor, _slots
+    if _executor is not None:
+        _executor.shutdown()
+    _executor = None
+    _slots = None
+
+# Worker side: rebuild the provider and run the parsing method
+def _parse(module, name, options, parser, method, args):
+    p = getattr(importlib.import_module(module), name)()
+    p.options = options
+    p.parser = parser
+    return getattr(p, method)(*args)
+
+# Run provider.method(*args), in the pool if enabled
+async def run(provider, method, *args):
+
+    if _executor is None:
+        return getattr(provider, method)(*args)
+
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(max_pending or 2 * workers)
+
+    async with _slots:
+        return await asyncio.get_running_loop().run_in_executor(
+            _executor,
+            _parse,
+            type(provider).__module__,
+            type(provider).__name__,
+            provider.options,
+            provider.parser,
+            method,
+            args
+        )
@@ -0,0 +1,67 @@
+# Per-host politeness limits for the fetch engine
+#
+# Every remote host gets its own limiter: at most max_concurrency requests
+# in flight and request starts spaced by 1 / max_rate seconds. Limits can be
+# overridden per host, e.g. for a server known to throttle aggressively.
+# Background requests (e.g. enclosure checks, providers/enclosures.py) have
+# limiters of their own, so they never take the slots and the rate budget
+# of scraping on the same host.
+
+import asyncio
+
+max_concurrency = 6     # concurrent requests per host
+max_rate = 5.0          # request starts per second per host, 0 means unlimited
+overrides = {}          # host -> (max_concurrency, max_rate)
+background_concurrency = 2  # concurrent background requests per host
+background_rate = 1.0       # background request starts per second per host, 0 means unlimited
+
+_limiters = {}
+_background_limiters = {}
+
+def configure(max_concurrency = None, max_rate = None, overrides = None, background_concurrency = None, background_rate = None):
+    module = globals()
+    for name, value in (
+        ( "max_concurrency" , max_concurrency ), ( "max_rate" , max_rate ), ( "overrides" , overrides ),
+        ( "background_concurrency" , background_concurrency ), ( "background_rate" , background_rate )
+    ):
+        if value is not None:
+            module[name] = value
+    reset()
+
+class HostLimiter():
+
+    def __init__(self, concurrency, rate):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 1.0 / rate if rate else 0
+        self.next_start = 0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        if self.interval:
+            loop_time = asyncio.get_running_loop().time()
+            start = max(loop_time, self.next_start)
+            self.next_start = start + self.interval
+            if start > loop_time:
+                try:
+                    await asyncio.sleep(start - loop_time)
+                except BaseException:
+                    self.semaphore.release()
+                    raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+def limiter(host):
+    if host not in _limiters:
+        _limiters[host] = HostLimiter(*overrides.get(host, ( max_concurrency , max_rate )))
+    return _limiters[host]
+
+def background_limiter(host):
+    if host not in _background_limiters:
+        _background_limiters[host] = HostLimiter(background_concurrency, background_rate)
+    return _background_limiters[host]
+
+def reset():
+    _limiters.clear()
+    _background_limiters.clear()
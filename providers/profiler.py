@@ -0,0 +1,126 @@
+# Sampling profiler of sources
+#
+# A background thread samples the stack of the event loop thread every
+# interval seconds (sys._current_frames(), no tracing hooks, so scraping
+# runs at full speed) and attributes each sample to the source being run:
+# the one of the innermost Provider instance found in the stack, as self or
+# as p (scraper.py scrape_feed). Samples of the idle loop are not kept.
+# Parsing done in parser processes (providers/pipeline.py) is not sampled.
+#
+# When a source ends (finish()), if it took at least threshold seconds its
+# stacks are written to <directory>/<source>.collapsed, one "frame;frame;...
+# count" line per stack (input of flamegraph.pl and speedscope), otherwise
+# they are dropped. stop() writes <directory>/profile_summary.txt with the
+# top functions of every profiled source, by own samples (the function
+# itself was running) and total samples (the function was in the stack).
+
+import os, sys, time, asyncio, logging, threading
+from collections import Counter
+from .Provider import Provider
+from .files import atomic_write
+
+# Stacks start at the task run by the event loop, the loop frames are left out
+LOOP_STEP = asyncio.events.Handle._run.__code__
+
+class Profiler():
+
+    def __init__(self, directory, interval = 0.01, threshold = 0, top = 20):
+        self.directory = directory
+        self.interval = interval
+        self.threshold = threshold
+        self.top = top
+        self.samples = {} # source -> Counter of stacks (tuples of labels, outermost first)
+        self.summary = {} # profiled source -> (duration, samples, top functions by own and by total samples)
+        self.labels = {} # code object -> label
+        self.idle = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.target = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok = True)
+        self.target = threading.get_ident()
+        self.running = True
+        self.thread = threading.Thread(target = self.run, name = "profiler", daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.sample(frame)
+
+    # file:function of a code object, package/__init__.py:function for packages
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            path = code.co_filename
+            name = os.path.basename(path)
+            if name == "__init__.py":
+                name = os.path.basename(os.path.dirname(path)) + "/" + name
+            label = self.labels[code] = "%s:%s" % ( name , getattr(code, "co_qualname", code.co_name) )
+        return label
+
+    def sample(self, frame):
+        stack = []
+        source = None
+        while frame is not None and frame.f_code is not LOOP_STEP:
+            code = frame.f_code
+            stack.append(self.label(code))
+            if source is None and ("self" in code.co_varnames or "p" in code.co_varnames):
+                f_locals = frame.f_locals
+                for name in ("self", "p"):
+                    p = f_locals.get(name)
+                    if isinstance(p, Provider) and p.source:
+                        source = p.source
+                        break
+            frame = frame.f_back
+        if source is None:
+            self.idle += 1
+            return
+        stack.reverse()
+        with self.lock:
+            self.samples.setdefault(source, Counter())[tuple(stack)] += 1
+
+    # Write (if slow enough) or drop the samples of a source that ended
+    def finish(self, source, duration):
+
+        with self.lock:
+            stacks = self.samples.pop(source, None)
+        if not stacks or duration < self.threshold:
+            return
+
+        path = os.path.join(self.directory, "%s.collapsed" % source)
+        with atomic_write(path) as f:
+            for stack, count in stacks.most_common():
+                f.write("%s %d\n" % ( ";".join(stack) , count ))
+
+        own = Counter()
+        total = Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        self.summary[source] = ( duration , sum(stacks.values()) , own.most_common(self.top) , total.most_common(self.top) )
+
+    def stop(self):
+
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+        lines = []
+        for source, (duration, samples, own, total) in sorted(self.summary.items(), key = lambda s: -s[1][0]):
+            lines.append("Source %s: %.1f s, %d samples (%.1f s on the event loop)" % ( source , duration , samples , samples * self.interval ))
+            for title, top in (( "own" , own ), ( "total" , total )):
+                lines.append("  %s time:" % title)
+                for label, count in top:
+                    lines.append("  %7.1f%%  %s" % ( 100.0 * count / samples , label ))
+            lines.append("")
+
+        path = os.path.join(self.directory, "profile_summary.txt")
+        with atomic_write(path) as f:
+            f.write("\n".join(lines))
+        logging.info("Profiles of %d sources in %s (%d idle samples)" % ( len(self.summary) , self.directory , self.idle ))
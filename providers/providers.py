@@ -1,2 +1,6 @@
-from .Halley import Halley
-from .Task import Task1, Task2
+# Providers are imported lazily on first access, e.g. providers.Halley
+# (see providers/registry.py)
+from . import registry
+
+def __getattr__(name):
+    return registry.get(name)
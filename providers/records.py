@@ -0,0 +1,79 @@
+# Compact item records, turned into rfeed objects only when serialized
+#
+# Providers return ItemRecord instances instead of graphs of rfeed Item,
+# Category, Enclosure and Guid objects: a record has __slots__ and holds
+# plain strings and tuples, categories as (domain, category) pairs and
+# enclosures as (url, length, type) triples. Items of many sources in flight
+# take a fraction of the memory, and pickle cheaply from parser processes.
+# FeedWriter (scraping/feeds.py) calls to_item() right before writing each
+# item, so rfeed objects only live for the time of their serialization.
+
+from rfeed import Item, Guid, Category, Enclosure
+
+class ItemRecord():
+
+    __slots__ = ("title", "link", "description", "pubDate", "guid", "categories", "enclosures", "enclosure_list")
+
+    def __init__(self, title = None, link = None, description = None, pubDate = None, guid = None, categories = (), enclosures = (), enclosure_list = True):
+        self.title = title
+        self.link = link
+        self.description = description
+        self.pubDate = pubDate
+        self.guid = guid # string or None
+        self.categories = tuple(categories) # (domain, category) pairs
+        self.enclosures = tuple(enclosures) # (url, length, type) triples
+        self.enclosure_list = enclosure_list # single enclosure or list in the rfeed Item
+
+    def __repr__(self):
+        return "<ItemRecord %s>" % ( self.guid or self.link )
+
+    # Guid, or link of items without guid
+    def key(self):
+        return self.guid or self.link
+
+    # Value of the first category with domain ending in #name, None if missing
+    def category(self, name):
+        suffix = "#" + name
+        for domain, category in self.categories:
+            if domain and domain.endswith(suffix):
+                return category
+        return None
+
+    # JSON-friendly dict (item store and item index format) and back
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "link": self.link,
+            "description": self.description,
+            "pubDate": self.pubDate,
+            "guid": self.guid,
+            "categories": [list(c) for c in self.categories],
+            "enclosures": [list(e) for e in self.enclosures],
+            "enclosure_list": self.enclosure_list
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            title = d["title"],
+            link = d["link"],
+            description = d["description"],
+            pubDate = d["pubDate"],
+            guid = d["guid"],
+            categories = [tuple(c) for c in d["categories"]],
+            enclosures = [tuple(e) for e in d["enclosures"]],
+            enclosure_list = d["enclosure_list"]
+        )
+
+    # rfeed Item, for serialization
+    def to_item(self):
+        enclosures = [Enclosure(url = e[0], length = e[1], type = e[2]) for e in self.enclosures]
+        return Item(
+            title = self.title,
+            link = self.link,
+            description = self.description,
+            pubDate = self.pubDate,
+            guid = Guid(self.guid) if self.guid else None,
+            categories = [Category(domain = c[0], category = c[1]) for c in self.categories],
+            enclosure = enclosures if self.enclosure_list else (enclosures[0] if enclosures else None)
+        )
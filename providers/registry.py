@@ -0,0 +1,91 @@
+# Lazy registry of providers
+#
+# The provider column of elenco_albi.csv names a Provider subclass, whose
+# module is imported only the first time the provider is requested, looking in:
+# 1. entry points of the "rt_scrapers.providers" group, so that providers can
+#    be shipped by other packages (e.g. Name = mypackage.module:Name)
+# 2. this package, by naming convention: class Name in providers/Name.py or,
+#    for numbered variants (Task1, Task2), in the module without the digits
+# The import time of every provider module is recorded (scraper.py --import-times).
+#
+# Instances are kept per source (id column of elenco_albi.csv) and reused as
+# long as provider and options of the source do not change, so opts() runs
+# once per source and not at every run.
+
+import re, time, logging, importlib
+from importlib.metadata import entry_points
+from .Provider import Provider
+
+GROUP = "rt_scrapers.providers"
+NAME = re.compile(r"^[A-Z][A-Za-z0-9_]*$")
+
+_classes = {}
+_instances = {}
+_entry_points = None
+import_times = {} # module name: seconds spent importing it
+
+def _import(module):
+    begin = time.perf_counter()
+    module = importlib.import_module(module)
+    import_times.setdefault(module.__name__, time.perf_counter() - begin)
+    return module
+
+def _entry_point(name):
+    global _entry_points
+    if _entry_points is None:
+        _entry_points = {ep.name: ep for ep in entry_points(group = GROUP)}
+    return _entry_points.get(name)
+
+# Candidate (module, class name) pairs for a provider name
+def _candidates(name):
+    ep = _entry_point(name)
+    if ep:
+        yield ep.module, ep.attr or name
+    if NAME.match(name):
+        yield "%s.%s" % ( __package__ , name ), name
+        base = name.rstrip("0123456789")
+        if base and base != name:
+            yield "%s.%s" % ( __package__ , base ), name
+
+# Provider class from its name, imported on first use
+def get(name):
+
+    if name in _classes:
+        return _classes[name]
+
+    for module, attr in _candidates(name):
+        try:
+            cls = getattr(_import(module), attr, None)
+        except ModuleNotFoundError as e:
+            if e.name != module:
+                raise # a dependency of the provider is missing
+            continue
+        if isinstance(cls, type) and issubclass(cls, Provider) and cls is not Provider:
+            _classes[name] = cls
+            return cls
+
+    raise AttributeError("Provider not found: %s" % name)
+
+# Provider instance of a source, reused while provider and options are the same
+def instance(source, name, options):
+
+    cached = _instances.get(source)
+    if cached and cached[0] == name and cached[1] == options:
+        return cached[2]
+
+    p = get(name)()
+    p.opts(options)
+    p.source = source
+    _instances[source] = ( name , options , p )
+    return p
+
+# Forget instances of sources not in sources (e.g. removed from the CSV)
+def prune(sources):
+    for source in set(_instances) - set(sources):
+        del _instances[source]
+
+# Log import time per provider module, slowest first
+def log_import_times():
+    for module, seconds in sorted(import_times.items(), key = lambda m: -m[1]):
+        providers = sorted(name for name, cls in _classes.items() if cls.__module__ == module)
+        logging.info("Imported %s (%s) in %.1f ms" % ( module , ", ".join(providers) , seconds * 1000 ))
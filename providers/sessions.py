@@ -0,0 +1,91 @@
+# Process-wide HTTP session and connection pool manager
+#
+# One aiohttp session per remote host, shared by every Provider instance:
+# dozens of sources live on the same host (e.g. halleyweb.com), so keeping
+# their connections alive saves a TCP/TLS handshake on almost every request.
+# Reuse is tracked with aiohttp tracing hooks: a "hit" is a request served by
+# an already open connection, a "miss" is a request that opened a new one.
+
+import logging
+from urllib.parse import urlsplit
+import aiohttp
+
+# Pool settings (see configure())
+pool_size = 10              # max open connections per host
+keepalive_timeout = 30      # seconds an idle connection is kept open
+retries = 2                 # retries on connection errors, timeouts and retry_statuses
+retry_statuses = (500, 502, 503, 504)
+backoff = 0.5               # seconds, doubled at every retry (with jitter)
+max_backoff = 10            # max seconds between two attempts
+timeout = 60                # max seconds for a whole request, body included
+connect_timeout = 10        # max seconds to connect (and wait for a pooled connection)
+read_timeout = 30           # max seconds between two reads of the response
+
+_sessions = {}
+_counters = {}
+
+def configure(pool_size = None, keepalive_timeout = None, retries = None, timeout = None, connect_timeout = None, read_timeout = None):
+    module = globals()
+    for name, value in (
+        ( "pool_size" , pool_size ),
+        ( "keepalive_timeout" , keepalive_timeout ),
+        ( "retries" , retries ),
+        ( "timeout" , timeout ),
+        ( "connect_timeout" , connect_timeout ),
+        ( "read_timeout" , read_timeout )
+    ):
+        if value is not None:
+            module[name] = value
+
+def host(url):
+    return urlsplit(url).netloc.lower()
+
+def count(host, counter, value = 1):
+    counters = _counters.setdefault(host, {"requests": 0, "hits": 0, "misses": 0, "retries": 0})
+    counters[counter] += value
+
+def _trace_config(host):
+
+    async def on_reuse(session, context, params):
+        count(host, "hits")
+
+    async def on_create(session, context, params):
+        count(host, "misses")
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_reuseconn.append(on_reuse)
+    trace_config.on_connection_create_end.append(on_create)
+    return trace_config
+
+# Return the shared session for the host of url, creating it on first use
+def session(url):
+    h = host(url)
+    s = _sessions.get(h)
+    if s is None or s.closed:
+        s = aiohttp.ClientSession(
+            connector = aiohttp.TCPConnector(limit = pool_size, keepalive_timeout = keepalive_timeout),
+            timeout = aiohttp.ClientTimeout(total = timeout, connect = connect_timeout, sock_read = read_timeout),
+            trace_configs = [_trace_config(h)]
+        )
+        _sessions[h] = s
+    return s
+
+# Pool counters, per host and summed over all hosts
+def stats():
+    total = {"requests": 0, "hits": 0, "misses": 0, "retries": 0}
+    for counters in _counters.values():
+        for counter, value in counters.items():
+            total[counter] += value
+    return {"total": total, "hosts": {h: dict(c) for h, c in _counters.items()}}
+
+def log_stats():
+    total = stats()["total"]
+    logging.info("Connection pools: %d requests, %d hits, %d misses, %d retries on %d hosts" % (
+        total["requests"], total["hits"], total["misses"], total["retries"], len(_counters)
+    ))
+
+async def close():
+    for s in _sessions.values():
+        if not s.closed:
+            await s.close()
+    _sessions.clear()
@@ -0,0 +1,99 @@
+# Persistent store of already scraped items (SQLite)
+#
+# Items are indexed by source (id column of elenco_albi.csv) and guid, so a
+# run only fetches the single item pages of acts never seen before and
+# rebuilds every feed from stored items plus the new ones.
+# Expired acts are evicted using their pubEnd category once they are missing
+# from the latest index of their source, all acts are evicted when missing
+# from the index for max_unseen_days.
+
+import sqlite3, json, time, logging
+from datetime import datetime
+from .Provider import Provider
+from .records import ItemRecord
+
+PUB_END = "item-category-pubEnd"
+
+class ItemStore():
+
+    def __init__(self, path, max_unseen_days = 30):
+        self.path = path
+        self.max_unseen_days = max_unseen_days
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                source TEXT NOT NULL,
+                guid TEXT NOT NULL,
+                data TEXT NOT NULL,
+                pub_end INTEGER,
+                last_seen INTEGER NOT NULL,
+                PRIMARY KEY (source, guid)
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS items_pub_end ON items (pub_end)")
+        self.db.commit()
+
+    # Epoch of the pubEnd category of an item, None if missing or unparsable
+    def pub_end(self, item):
+        pub_end = item.category(PUB_END)
+        if not pub_end:
+            return None
+        try:
+            return int(datetime.strptime(pub_end, Provider.output_format).timestamp())
+        except ValueError:
+            return None
+
+    # All guids stored for a source
+    def guids(self, source):
+        return set(row[0] for row in self.db.execute("SELECT guid FROM items WHERE source = ?", (source,)))
+
+    def get(self, source, guid):
+        row = self.db.execute("SELECT data FROM items WHERE source = ? AND guid = ?", (source, guid)).fetchone()
+        return ItemRecord.from_dict(json.loads(row[0])) if row else None
+
+    def put(self, source, item, commit = True):
+        d = item.to_dict()
+        self.db.execute(
+            "INSERT OR REPLACE INTO items (source, guid, data, pub_end, last_seen) VALUES (?, ?, ?, ?, ?)",
+            (source, d["guid"] or d["link"], json.dumps(d), self.pub_end(item), int(time.time()))
+        )
+        if commit:
+            self.db.commit()
+
+    # Mark guids as still listed in the source index
+    def touch(self, source, guids):
+        now = int(time.time())
+        self.db.executemany(
+            "UPDATE items SET last_seen = ? WHERE source = ? AND guid = ?",
+            [(now, source, guid) for guid in guids]
+        )
+        self.db.commit()
+
+    # Mark the acts listed in the latest index of source as still listed,
+    # when the index is unchanged: they are the ones touched last
+    def touch_latest(self, source):
+        self.db.execute(
+            "UPDATE items SET last_seen = ? WHERE source = ? AND last_seen = (SELECT MAX(last_seen) FROM items WHERE source = ?)",
+            (int(time.time()), source, source)
+        )
+        self.db.commit()
+
+    # Drop expired acts (one day after pubEnd) no longer listed in the latest
+    # index of their source, and acts no longer listed for too long
+    # Expired acts still listed are kept, or they would be fetched again at every run
+    def evict(self, now = None):
+        now = int(now or time.time())
+        cursor = self.db.execute(
+            """
+            DELETE FROM items WHERE
+                (pub_end IS NOT NULL AND pub_end < ? AND last_seen < (SELECT MAX(latest.last_seen) FROM items AS latest WHERE latest.source = items.source))
+                OR last_seen < ?
+            """,
+            (now - 86400, now - self.max_unseen_days * 86400)
+        )
+        self.db.commit()
+        logging.info("Item store %s: %d expired items evicted" % ( self.path , cursor.rowcount ))
+        return cursor.rowcount
+
+    def close(self):
+        self.db.close()
@@ -1,84 +1,464 @@
-import sys, csv, logging, arrow
-from providers import providers
+import os, csv, time, logging, argparse, asyncio, arrow
+from providers import registry, fetch, sessions, politeness, pipeline, metrics, cassettes
+from providers.profiler import Profiler
+from providers.Provider import Provider
+from providers.store import ItemStore
+from providers.enclosures import EnclosureResolver
+from scraping.scheduler import HostScheduler
+from scraping.workqueue import WorkQueue
+from scraping.refresh import RefreshSchedule
+from scraping.durations import Durations
+from scraping.daemon import Daemon
+from scraping import shards, catalog
+from scraping.feeds import FeedWriter, Budget
+from scraping.itemindex import ItemIndex
 from rfeed import *
-from threading import Thread
-from queue import Queue, Empty
-
-if len(sys.argv) > 2:
-    csv_filename = sys.argv[1].strip()
-    download_dir = sys.argv[2].strip()
-else:
-    print("Usage: python %s %s %s" % (
-        sys.argv[0],
-        "[CSV filename]",
-        "[download directory]"
-    ))
-    exit()
+
+parser = argparse.ArgumentParser(description = "Scrape albi pretori listed in a CSV file and write RSS feeds")
+parser.add_argument("csv_filename", help = "CSV filename")
+parser.add_argument("download_dir", help = "download directory")
+parser.add_argument("--spiders", type = int, default = 50, help = "number of sources scraped concurrently (default: 50)")
+parser.add_argument("--fanout", type = int, default = 8, help = "single item pages fetched concurrently per source (default: 8)")
+parser.add_argument("--requests", type = int, default = 200, help = "max number of in-flight HTTP requests (default: 200)")
+parser.add_argument("--pool-size", type = int, default = 10, help = "max open connections per host (default: 10)")
+parser.add_argument("--retries", type = int, default = 2, help = "retries with jittered backoff on connection errors, timeouts and 5xx responses (default: 2)")
+parser.add_argument("--timeout", type = float, default = 60, help = "max seconds for a single HTTP request (default: 60)")
+parser.add_argument("--connect-timeout", type = float, default = 10, help = "max seconds to connect to a host (default: 10)")
+parser.add_argument("--budget", type = float, default = 900, help = "max seconds spent on a source, items scraped so far make a partial feed, 0 for unlimited (default: 900)")
+parser.add_argument("--breaker", help = "JSON file of the circuit breaker, hosts that keep failing are skipped across runs (default: disabled)")
+parser.add_argument("--breaker-failures", type = int, default = 5, help = "failed requests in a row opening the circuit of a host (default: 5)")
+parser.add_argument("--breaker-cooldown", type = float, default = 600, help = "seconds before probing a host with open circuit, doubled at every failed probe (default: 600)")
+parser.add_argument("--store", help = "SQLite item store, only new acts are fetched (default: disabled)")
+parser.add_argument("--cache", help = "on-disk HTTP cache directory, unchanged sources keep their previous feed (default: disabled)")
+parser.add_argument("--host-sources", type = int, default = 4, help = "sources of the same host scraped concurrently (default: 4)")
+parser.add_argument("--host-requests", type = int, default = 6, help = "in-flight HTTP requests per host (default: 6)")
+parser.add_argument("--host-rate", type = float, default = 5.0, help = "HTTP requests per second per host, 0 for unlimited (default: 5)")
+parser.add_argument("--parser", choices = ["lxml", "bs4"], default = "lxml", help = "parsing backend of providers (default: lxml)")
+parser.add_argument("--enclosures", help = "SQLite cache of enclosure sizes and types, resolved in background by HEAD requests (default: disabled)")
+parser.add_argument("--enclosure-workers", type = int, default = 4, help = "concurrent enclosure checks (default: 4)")
+parser.add_argument("--enclosure-rate", type = float, default = 1.0, help = "enclosure checks per second per host, on top of --host-rate, 0 for unlimited (default: 1)")
+parser.add_argument("--enclosure-wait", type = float, default = 60, help = "seconds spent resolving enclosures left at the end of a run (default: 60)")
+parser.add_argument("--item-index", help = "SQLite index of the items of all sources, new and changed items get a new seq (default: disabled)")
+parser.add_argument("--item-log", help = "JSON Lines file where new and changed items of all sources are appended (default: disabled)")
+parser.add_argument("--index-only", action = "store_true", help = "with --store, refresh known acts from index pages where providers support it (Halley grid), single item pages are fetched for new acts only")
+parser.add_argument("--parsers", type = int, default = 0, help = "parser processes, 0 to parse in the fetching process (default: 0)")
+parser.add_argument("--parse-queue", type = int, default = 0, help = "fetched pages waiting for a parser process (default: 2 * parsers)")
+parser.add_argument("--metrics-dir", help = "write scraper_metrics.json and scraper.prom (Prometheus textfile) in this directory")
+parser.add_argument("--import-times", action = "store_true", help = "log the import time of every provider module")
+parser.add_argument("--durations", help = "JSON file of source durations, recorded at every run: longest sources are scraped first (default: disabled)")
+parser.add_argument("--sources", help = "sources.json joined with the CSV into the source catalog, \"\" to ignore it (default: sources.json next to the CSV file, if any)")
+parser.add_argument("--catalog", help = "compiled source catalog, rebuilt when the CSV or sources.json change (default: built at every run)")
+parser.add_argument("--region", dest = "regions", action = "append", help = "only scrape sources of this region (channel-category-region), can be repeated")
+parser.add_argument("--provider", dest = "providers", action = "append", help = "only scrape sources of this provider, can be repeated")
+parser.add_argument("--inactive", action = "store_true", help = "also scrape sources that are not active in sources.json")
+parser.add_argument("--shard", type = shards.parse, help = "only scrape shard i of N (i/N), sources are assigned by consistent hashing of their id")
+parser.add_argument("--queue", help = "SQLite work queue shared by processes and nodes, resumes the run after a crash (default: disabled)")
+parser.add_argument("--run", help = "run name in the work queue, required with --queue: processes and restarts with the same name share the run and skip sources already done in it (e.g. a cron timestamp)")
+parser.add_argument("--lease", type = int, default = 900, help = "seconds a source stays leased to a process without renewal (default: 900)")
+parser.add_argument("--schedule", help = "SQLite refresh schedule learned from past runs, only due sources are scraped (default: disabled)")
+parser.add_argument("--min-interval", type = float, default = 1.0, help = "min hours between two scrapes of a source with --schedule (default: 1)")
+parser.add_argument("--max-interval", type = float, default = 72.0, help = "max hours between two scrapes of a source with --schedule (default: 72)")
+parser.add_argument("--daemon", action = "store_true", help = "keep running: reload the CSV when it changes and scrape sources when they are due")
+parser.add_argument("--interval", type = float, default = 1.0, help = "hours between two scrapes of a source in daemon mode without --schedule (default: 1)")
+parser.add_argument("--control", default = "127.0.0.1:8760", help = "address of the daemon control endpoint: /status, /refresh/<id>, /drain (default: 127.0.0.1:8760)")
+parser.add_argument("--keepalive", type = float, default = 30, help = "seconds idle connections are kept open (default: 30)")
+parser.add_argument("--record", help = "save the responses of every source in a cassette (<id>.cassette) in this directory")
+parser.add_argument("--replay", help = "serve responses from the cassettes in this directory, without network access")
+parser.add_argument("--profile", help = "sample the stacks of every source and write <id>.collapsed and profile_summary.txt in this directory")
+parser.add_argument("--profile-threshold", type = float, default = 0, help = "only write the profiles of sources taking at least these seconds (default: 0)")
+parser.add_argument("--profile-interval", type = float, default = 0.01, help = "seconds between two stack samples (default: 0.01)")
+parser.add_argument("--profile-top", type = int, default = 20, help = "functions per source in profile_summary.txt (default: 20)")
+args = parser.parse_args()
+
+# Providers are imported lazily, so logging is configured here once for all
+logging.basicConfig(level = logging.INFO)
+
+if args.daemon and args.queue:
+    parser.error("--queue is for one-shot runs, it cannot be used with --daemon")
+if args.queue and not args.run:
+    parser.error("--queue needs --run: a run name per scheduled run, shared by its processes and restarts")
+if args.record and args.replay:
+    parser.error("--record and --replay cannot be used together")
+if args.index_only and not args.store:
+    parser.error("--index-only needs --store: enclosures and act dates of known acts come from the store")
+
+csv_filename = args.csv_filename.strip()
+download_dir = args.download_dir.strip()
+sources_filename = args.sources
+if sources_filename is None:
+    sources_filename = os.path.join(os.path.dirname(os.path.abspath(csv_filename)), "sources.json")
+    if not os.path.exists(sources_filename):
+        sources_filename = None
 
 now = arrow.now()
-q = Queue()
+store = ItemStore(args.store) if args.store else None
+durations = Durations(args.durations) if args.durations else None
+item_index = ItemIndex(args.item_index, args.item_log) if args.item_index or args.item_log else None
+resolver = EnclosureResolver(args.enclosures, workers = args.enclosure_workers) if args.enclosures else None
+profiler = Profiler(args.profile, interval = args.profile_interval, threshold = args.profile_threshold, top = args.profile_top) if args.profile else None
+schedule = RefreshSchedule(args.schedule, min_interval = args.min_interval, max_interval = args.max_interval) if args.schedule else None
+queue = WorkQueue(args.queue, args.run, lease = args.lease) if args.queue else None
 
-def spider(q):
+def feed_path(line):
+    return download_dir + "/%s.xml" % line["feed_name"].split(".")[0]
 
-    while not q.empty():
+# Provider instance of a CSV row, None if the provider is unknown
+# Providers are imported on first use and instances are reused per source
+# (providers/registry.py)
+def provider(line):
 
-        try:
-            line = q.get(timeout = 1)
-        except Empty:
+    try:
+        p = registry.instance(line["id"], line["provider"], line["options"])
+    except AttributeError:
+        logging.warning("Requested provider not found: %s" % line["provider"])
+        return None
+
+    p.store = store
+    return p
+
+# Rows of the CSV scraped by this process
+def in_shard(line):
+    return not args.shard or shards.shard_of(line["id"], args.shard[1]) == args.shard[0]
+
+sources_catalog = None
+selected_ids = set()
+
+# Source catalog (scraping/catalog.py), reloaded when the CSV or sources.json
+# change, and ids of the sources selected by --region, --provider and --inactive
+# If a reload fails (e.g. a bad row, sources.json missing) the previous
+# catalog is kept, so that a daemon keeps running
+def selection():
+    global sources_catalog, selected_ids
+    try:
+        if sources_catalog is None or sources_catalog.signature != catalog.signature(csv_filename, sources_filename):
+            loaded = catalog.load(csv_filename, sources_filename, args.catalog)
+            selected_ids = set(s.id for s in loaded.select(args.regions, args.providers, args.inactive))
+            sources_catalog = loaded
+            sources_catalog.log_stats()
+    except (ValueError, OSError, csv.Error) as e:
+        if sources_catalog is None:
+            raise
+        logging.warning("Cannot reload the source catalog, keeping the previous one: %s" % e)
+    return sources_catalog, selected_ids
+
+# Filter of the CSV rows scraped by this process, for a daemon load
+def selector():
+    ids = selection()[1]
+    return lambda line: in_shard(line) and line["id"] in ids
+
+async def scrape(line, p):
+
+    p.reuse_feed = os.path.exists(feed_path(line))
+    metrics.start(line["id"], line["provider"])
+    start = time.perf_counter()
+    if args.record or args.replay:
+        with cassettes.for_source(args.record or args.replay, line["id"], "record" if args.record else "replay"):
+            status = await scrape_feed(line, p)
+    else:
+        status = await scrape_feed(line, p)
+    metrics.finish(line["id"], status, time.perf_counter() - start)
+    if profiler:
+        profiler.finish(line["id"], time.perf_counter() - start)
+    if durations and status != "error":
+        durations.record(line["id"], time.perf_counter() - start)
+    return status
+
+# Scrape a source into its feed, return the outcome: ok, unchanged, partial or error
+async def scrape_feed(line, p):
+
+    feed = Feed(
+        title = "AlboPOP - %s - %s" % ( line["channel-category-type"] , line["channel-category-name"] ),
+        link = p.feed_base_url + line["feed_name"],
+        description = "*non ufficiale* RSS feed dell'Albo Pretorio del %s" % line["channel-category-name"],
+        language = p.language,
+        pubDate = p.format_datetime(now),
+        webMaster = line["webmaster"],
+        docs = p.docs_base_url + line["docs"].lower(),
+        copyright = "Copyright %d %s" % ( now.year , line["channel-category-name"] ),
+        categories = [
+            Category( domain = p.specs_base_url + "#" + l[0], category = l[1] )
+            for l in line.items() if l[0].startswith("channel-category-") and l[1]
+        ]
+    )
+
+    # Items are streamed to a temporary file, the feed is replaced only if changed
+    writer = FeedWriter(feed_path(line), feed)
+    budget = Budget(args.budget)
+    items = budget.items(p.scrape())
+
+    # Known enclosure sizes and types are filled in, the others are resolved in background
+    if resolver:
+        items = resolver.items(items)
+
+    # Items of the feed are staged in the aggregated item index, and indexed once it is written
+    if item_index:
+        items = item_index.items(line["id"], items)
+
+    try:
+        await writer.write(items)
+        return finish_feed(line, p, writer, budget)
+    except Exception as e:
+        logging.warning("Error scraping source %s: %s" % ( line["id"] , e ))
+        metrics.count("errors")
+        writer.discard()
+        fetch.forget_index(line["id"])
+        if item_index:
+            item_index.discard(line["id"])
+        if schedule:
+            schedule.failed(line["id"])
+        return "error"
+
+# Commit (or discard) a written feed and record its outcome
+def finish_feed(line, p, writer, budget):
+
+    if p.unchanged:
+        logging.info("Source %s unchanged, keeping previous feed" % line["id"])
+        writer.discard()
+        if item_index:
+            item_index.discard(line["id"])
+        if schedule:
+            schedule.record(line["id"], None, changed = False)
+        return "unchanged"
+
+    # Out of time: the items scraped so far make a partial feed, retried soon
+    # (and in full, its index page cannot short-circuit the next run)
+    if budget.exceeded:
+        logging.warning("Source %s over its %g s budget, %d items scraped" % ( line["id"] , args.budget , writer.count ))
+        metrics.count("items", writer.count)
+        fetch.forget_index(line["id"])
+        if writer.count:
+            writer.commit()
+            if item_index:
+                item_index.commit(line["id"])
+        else:
+            writer.discard()
+            if item_index:
+                item_index.discard(line["id"])
+        if schedule:
+            schedule.failed(line["id"])
+        return "partial"
+
+    # The index page can short-circuit the next run only if no page failed
+    metrics.count("items", writer.count)
+    fetch.forget_index(line["id"])
+    changed = writer.commit()
+    if p.errors:
+        logging.warning("Source %s: %d pages failed, scraped again at next run" % ( line["id"] , p.errors ))
+    else:
+        fetch.complete_index(line["id"], p.index_digest)
+    if item_index:
+        item_index.commit(line["id"])
+    if schedule:
+        interval = schedule.record(line["id"], writer.guids, changed = changed)
+        logging.info("Source %s due again in %.1f hours" % ( line["id"] , interval ))
+    return "ok"
+
+running = {} # source id -> provider instance being scraped
+idle_spiders = 0
+
+# Spiders left without work lend their share of single item pages to the
+# sources still running, so the last big sources are not scraped by a
+# single spider while the others wait (within per-host limits)
+def rebalance():
+    boost = min(3 * args.fanout, idle_spiders * args.fanout // max(1, len(running)))
+    for p in running.values():
+        p.boost = boost
+
+async def spider(scheduler):
+
+    global idle_spiders
+
+    while True:
+
+        job = await scheduler.get()
+        if job is None:
+            idle_spiders += 1
+            rebalance()
             break
 
+        host, (line, p) = job
         try:
-            p = getattr(providers, line["provider"])()
-            p.opts(line["options"])
-        except AttributeError as e:
-            logging.warning("Requested provider not found: %s" % line["provider"])
-            q.task_done()
-            continue
-
-        items = p.scrape()
-
-        feed = Feed(
-            title = "AlboPOP - %s - %s" % ( line["channel-category-type"] , line["channel-category-name"] ),
-            link = p.feed_base_url + line["feed_name"],
-            description = "*non ufficiale* RSS feed dell'Albo Pretorio del %s" % line["channel-category-name"],
-            language = p.language,
-            pubDate = p.format_datetime(now),
-            webMaster = line["webmaster"],
-            docs = p.docs_base_url + line["docs"].lower(),
-            copyright = "Copyright %d %s" % ( now.year , line["channel-category-name"] ),
-            categories = [
-                Category( domain = p.specs_base_url + "#" + l[0], category = l[1] )
-                for l in line.items() if l[0].startswith("channel-category-") and l[1]
-            ],
-            items = [item for item in items]
-        )
-
-        with open(download_dir + "/%s.xml" % line["feed_name"].split(".")[0],"w") as f:
-            f.write(feed.rss())
-
-        q.task_done()
-
-with open(sys.argv[1]) as f:
-    reader = csv.DictReader(f)
-    for line in reader:
-        q.put(line)
-
-num_spiders = 10
-spiders = []
-
-logging.info("Starting scraper with %d spiders on %d sources..." % ( num_spiders , q.qsize() ))
-
-for n in range(num_spiders):
-    t = Thread(
-        name = "Spider #%d" % n,
-        target = spider,
-        args = (q,)
+            # Sources done, or being scraped by another process, are skipped
+            if queue and not queue.claim(line["id"]):
+                continue
+            running[line["id"]] = p
+            rebalance()
+            try:
+                status = await scrape(line, p)
+            except Exception as e:
+                logging.warning("Error scraping source %s: %s" % ( line["id"] , e ))
+                status = "error"
+            if queue:
+                queue.complete(line["id"], status)
+        finally:
+            running.pop(line["id"], None)
+            p.boost = 0
+            await scheduler.done(host)
+
+# Keep the leases of the sources being scraped
+async def renew_leases():
+    while True:
+        await asyncio.sleep(queue.lease / 3)
+        queue.renew()
+
+# Log the slowest sources and export metrics of the run
+def report():
+
+    for source, duration in metrics.slowest(5):
+        logging.info("Slow source %s: %.1f s" % ( source , duration ))
+
+    for source, peak, growth in metrics.largest(5):
+        logging.info("Memory of source %s: peak RSS %.1f MB (+%.1f MB)" % ( source , peak / 1048576 , growth / 1048576 ))
+
+    if args.metrics_dir:
+        os.makedirs(args.metrics_dir, exist_ok = True)
+        metrics.write_json(os.path.join(args.metrics_dir, "scraper_metrics.json"))
+        metrics.write_prometheus(os.path.join(args.metrics_dir, "scraper.prom"))
+
+# All spiders are coroutines on a single event loop: they wait on remote
+# servers concurrently, while fetch.max_in_flight bounds open requests.
+# Sources are handed out by host (scraping/scheduler.py) so that no single
+# server gets all the spiders at once.
+async def main():
+    global idle_spiders
+
+    scheduler = HostScheduler(max_per_host = args.host_sources)
+    jobs = {}
+
+    sources, ids = selection()
+    lines = [s.row for s in sources.sources if s.id in ids and in_shard(s.row)]
+    logging.info("%d sources selected out of %d" % ( len(lines) , len(sources) ))
+
+    # Sources not due yet keep their previous feed
+    if schedule:
+        due = set(schedule.due([line["id"] for line in lines], now.timestamp()))
+        logging.info("%d sources due out of %d" % ( len(due) , len(lines) ))
+        lines = [line for line in lines if line["id"] in due]
+
+    for line in lines:
+        p = provider(line)
+        if p:
+            jobs[line["id"]] = ( sources.get(line["id"]).host , ( line , p ) )
+            scheduler.put(*jobs[line["id"]], cost = durations.get(line["id"]) if durations else 0)
+
+    if queue:
+        queue.add(jobs)
+        renewer = asyncio.ensure_future(renew_leases())
+
+    num_spiders = args.spiders
+
+    if args.import_times:
+        registry.log_import_times()
+
+    if store:
+        store.evict(now.timestamp())
+
+    logging.info("Starting scraper with %d spiders on %d sources from %d hosts..." % ( num_spiders , scheduler.qsize() , scheduler.hosts() ))
+
+    try:
+        while True:
+            # Spiders idle in a previous round are busy again on leases taken over
+            idle_spiders = 0
+            await asyncio.gather(*[spider(scheduler) for n in range(num_spiders)])
+            if not queue:
+                break
+            # Wait for sources leased by other processes: if one of them
+            # crashed, its sources are scraped here when the lease expires
+            leased = {source: until for source, until in queue.leased().items() if source in jobs}
+            if not leased:
+                break
+            logging.info("Waiting for %d sources leased by other processes..." % len(leased))
+            await asyncio.sleep(max(1, min(min(leased.values()) - time.time(), queue.lease / 3)))
+            for source in leased:
+                scheduler.put(*jobs[source])
+    finally:
+        if queue:
+            renewer.cancel()
+            queue.release()
+            queue.log_stats()
+            queue.close()
+        log_makespan(num_spiders)
+        await close()
+
+    logging.info("... done!")
+
+# Duration of the run against its lower bound: total work over spiders,
+# or the longest source
+def log_makespan(spiders):
+    seconds = [r["duration"] for r in metrics.summary()["sources"].values()]
+    if seconds:
+        logging.info("Run took %.1f s for %.1f s of work on %d spiders, ideal %.1f s" % (
+            time.time() - metrics.started, sum(seconds), spiders, max(sum(seconds) / spiders, max(seconds))
+        ))
+
+async def close():
+    if durations:
+        durations.save()
+    if resolver:
+        await resolver.close(args.enclosure_wait)
+    if item_index:
+        item_index.log_stats()
+        item_index.close()
+    if schedule:
+        schedule.log_stats()
+        schedule.close()
+    sessions.log_stats()
+    if profiler:
+        profiler.stop()
+    report()
+    await fetch.close()
+    pipeline.shutdown()
+    if store:
+        store.close()
+
+last_report = last_eviction = 0
+
+# Daemon mode: export metrics every minute and evict expired items every day
+def housekeeping():
+    global last_report, last_eviction
+    if time.time() - last_report >= 60:
+        report()
+        last_report = time.time()
+    if store and time.time() - last_eviction >= 86400:
+        store.evict()
+        last_eviction = time.time()
+
+# Daemon mode: feeds are dated when their source is scraped
+async def scrape_now(line, p):
+    global now
+    now = arrow.now()
+    return await scrape(line, p)
+
+# Daemon mode: one process loads the CSV once and keeps scraping due
+# sources (scraping/daemon.py), with warm connection pools and providers
+async def daemon():
+
+    host, port = args.control.rsplit(":", 1)
+    d = Daemon(
+        csv_filename, provider, scrape_now,
+        due = schedule.due if schedule else None,
+        interval = args.interval * 3600,
+        spiders = args.spiders,
+        max_per_host = args.host_sources,
+        selector = selector
     )
-    spiders.append(t)
-    t.start()
 
-for t in spiders:
-    t.join()
+    try:
+        await d.run(host, int(port), periodic = housekeeping)
+    finally:
+        await close()
 
-logging.info("... done!")
+    logging.info("... daemon stopped")
 
+fetch.configure(max_requests = args.requests, cache_dir = args.cache, breaker_path = args.breaker, breaker_failures = args.breaker_failures, breaker_cooldown = args.breaker_cooldown)
+sessions.configure(pool_size = args.pool_size, keepalive_timeout = args.keepalive, retries = args.retries, timeout = args.timeout, connect_timeout = args.connect_timeout)
+politeness.configure(max_concurrency = args.host_requests, max_rate = args.host_rate, background_rate = args.enclosure_rate)
+Provider.concurrency = args.fanout
+Provider.parser = args.parser
+Provider.index_only = args.index_only
+pipeline.configure(workers = args.parsers, max_pending = args.parse_queue)
+pipeline.start()
+if profiler:
+    profiler.start() # after the parser processes are forked
+fetch.observers.append(metrics.observe)
+asyncio.run(daemon() if args.daemon else main())
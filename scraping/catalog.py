@@ -0,0 +1,193 @@
+# Compiled catalog of sources: elenco_albi.csv joined with sources.json
+#
+# elenco_albi.csv tells how to scrape a source (provider, options, feed
+# metadata), sources.json which sources are published (active flag, feed
+# url, maintainer). build() validates both files and joins them by feed file
+# name, or by ISTAT code where feed names differ: CSV rows without an entry
+# in sources.json are active. Sources are indexed by id and ISTAT code, and
+# their host (the one of the provider index page) is resolved once.
+#
+# load() keeps the compiled catalog in a pickle file and rebuilds it only
+# when the modification time or size of one of the inputs changed, so runs
+# get the joined, filtered and grouped sources without parsing anything.
+
+import os, csv, json, pickle, logging
+from providers import registry
+from providers.files import atomic_write
+
+VERSION = 1
+CSV_REQUIRED = ("id", "feed_name", "provider", "options", "channel-category-uid")
+
+class Source():
+
+    __slots__ = ("id", "istat_code", "provider", "options", "host", "region", "province", "active", "row", "catalog_id", "feed", "url", "maintainer")
+
+    def __init__(self, row, istat_code, host):
+        self.id = row["id"]
+        self.istat_code = istat_code
+        self.provider = row["provider"]
+        self.options = row["options"]
+        self.host = host # None if the provider is unknown
+        self.region = row.get("channel-category-region")
+        self.province = row.get("channel-category-province")
+        self.active = True
+        self.row = row # CSV row, as read by csv.DictReader
+        # From sources.json, None if the source is missing there
+        self.catalog_id = self.feed = self.url = self.maintainer = None
+
+    def __repr__(self):
+        return "<Source %s %s%s>" % ( self.id , self.provider , "" if self.active else " inactive" )
+
+class Catalog():
+
+    def __init__(self, sources, signature = None, warnings = ()):
+        self.sources = sources # in CSV order
+        self.signature = signature
+        self.warnings = list(warnings)
+        self.by_id = {s.id: s for s in sources}
+        self.by_istat = {}
+        for s in sources:
+            if s.istat_code is not None:
+                self.by_istat.setdefault(s.istat_code, []).append(s)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def get(self, id):
+        return self.by_id.get(id)
+
+    # Sources of an ISTAT code (a comune can have several albi)
+    def istat(self, code):
+        return self.by_istat.get(int(code), [])
+
+    # Sources of the given regions and providers (all if None), active ones only unless inactive
+    def select(self, regions = None, providers = None, inactive = False):
+        regions = set(r.lower() for r in regions) if regions else None
+        providers = set(providers) if providers else None
+        return [
+            s for s in self.sources
+            if (inactive or s.active)
+            and (regions is None or (s.region or "").lower() in regions)
+            and (providers is None or s.provider in providers)
+        ]
+
+    # Sources grouped by host, in CSV order
+    def by_host(self, sources = None):
+        hosts = {}
+        for s in self.sources if sources is None else sources:
+            hosts.setdefault(s.host, []).append(s)
+        return hosts
+
+    def log_stats(self):
+        inactive = sum(1 for s in self.sources if not s.active)
+        logging.info("Catalog: %d sources (%d inactive) on %d hosts" % ( len(self.sources) , inactive , len(self.by_host()) ))
+
+def _istat(uid):
+    try:
+        scheme, code = uid.split(":", 1)
+        return int(code) if scheme == "istat" else None
+    except (AttributeError, ValueError):
+        return None
+
+def _host(provider, options):
+    try:
+        return registry.get(provider)().opts(options).host()
+    except AttributeError:
+        return None
+
+# Stat of the inputs, a change means the catalog must be rebuilt
+def signature(csv_path, json_path = None):
+    result = [VERSION]
+    for path in (csv_path, json_path):
+        if path:
+            stat = os.stat(path)
+            result.append(( os.path.abspath(path) , stat.st_mtime_ns , stat.st_size ))
+    return tuple(result)
+
+# Validate and join the inputs, raise ValueError if the CSV cannot be used
+def build(csv_path, json_path = None):
+
+    sig = signature(csv_path, json_path)
+    warnings = []
+
+    with open(csv_path, newline = "") as f:
+        reader = csv.DictReader(f)
+        missing = [c for c in CSV_REQUIRED if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError("%s: missing columns %s" % ( csv_path , ", ".join(missing) ))
+        rows = list(reader)
+
+    sources = []
+    seen = set()
+    for n, row in enumerate(rows, 2):
+        empty = [c for c in ("id", "provider", "options") if not (row.get(c) or "").strip()]
+        if empty:
+            raise ValueError("%s line %d: empty %s" % ( csv_path , n , ", ".join(empty) ))
+        if row["id"] in seen:
+            raise ValueError("%s line %d: duplicate id %s" % ( csv_path , n , row["id"] ))
+        seen.add(row["id"])
+        istat_code = _istat(row["channel-category-uid"])
+        if istat_code is None:
+            warnings.append("source %s: no ISTAT code in %r" % ( row["id"] , row["channel-category-uid"] ))
+        host = _host(row["provider"], row["options"])
+        if host is None:
+            warnings.append("source %s: unknown provider %s" % ( row["id"] , row["provider"] ))
+        sources.append(Source(row, istat_code, host))
+
+    if json_path:
+
+        with open(json_path) as f:
+            entries = json.load(f)
+        if not isinstance(entries, list):
+            raise ValueError("%s: a list of sources is expected" % json_path)
+
+        by_feed = {}
+        by_istat = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                warnings.append("%s: not a source %r" % ( json_path , entry ))
+                continue
+            if entry.get("feed"):
+                by_feed.setdefault(entry["feed"].rsplit("/", 1)[-1], entry)
+            if isinstance(entry.get("istat_code"), int):
+                by_istat.setdefault(entry["istat_code"], []).append(entry)
+
+        for s in sources:
+            entry = by_feed.get(s.row["feed_name"])
+            if entry is None and len(by_istat.get(s.istat_code, [])) == 1:
+                entry = by_istat[s.istat_code][0]
+            if entry is None:
+                warnings.append("source %s: not in %s, kept active" % ( s.id , json_path ))
+                continue
+            s.active = bool(entry.get("active", 1))
+            s.catalog_id = entry.get("id")
+            s.feed = entry.get("feed")
+            s.url = entry.get("url")
+            s.maintainer = entry.get("maintainer")
+
+    return Catalog(sources, sig, warnings)
+
+# Catalog of the inputs, from cache_path unless an input changed since it was built
+def load(csv_path, json_path = None, cache_path = None):
+
+    sig = signature(csv_path, json_path)
+
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                catalog = pickle.load(f)
+            if catalog.signature == sig:
+                return catalog
+        except Exception as e:
+            logging.warning("Ignoring broken catalog %s: %s" % ( cache_path , e ))
+
+    catalog = build(csv_path, json_path)
+    for warning in catalog.warnings:
+        logging.warning("Catalog: %s" % warning)
+
+    if cache_path:
+        with atomic_write(cache_path, "wb") as f:
+            pickle.dump(catalog, f, pickle.HIGHEST_PROTOCOL)
+        logging.info("Catalog %s built from %s%s" % ( cache_path , csv_path , " and %s" % json_path if json_path else "" ))
+
+    return catalog
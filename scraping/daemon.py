@@ -0,0 +1,194 @@
+# Long-running scraper: sources dispatched continuously on a schedule
+#
+# The CSV is loaded once and reloaded when its modification time or size
+# changes: new sources are scheduled at once, removed ones are forgotten,
+# the others keep their provider instance (providers/registry.py). HTTP
+# connection pools, parser processes and imported providers stay warm for
+# the whole life of the process.
+#
+# Every tick, sources that are due and not already queued or running are
+# handed to the spiders through a persistent HostScheduler. Due times come
+# from a due(sources, now) function (e.g. RefreshSchedule.due), by default a
+# source is due interval seconds after its previous scrape.
+#
+# A small HTTP control endpoint, meant to listen on localhost only:
+# - GET  /status: sources, queued and running sources, outcome of the last scrapes
+# - POST /refresh/<source id>: scrape a source now
+# - POST /drain: stop dispatching, wait for running sources and exit
+# SIGTERM and SIGINT drain as well.
+
+import os, csv, json, time, signal, asyncio, logging
+from aiohttp import web
+from providers import registry
+from .scheduler import HostScheduler
+
+class Daemon():
+
+    def __init__(self, csv_filename, provider, scrape, due = None, interval = 3600, spiders = 50, max_per_host = 4, tick = 5, selector = None):
+        self.csv_filename = csv_filename
+        self.provider = provider # CSV row -> provider instance or None
+        self.scrape = scrape # async (row, provider instance) -> ok, unchanged or error
+        self.due = due or self.due_after_interval
+        self.interval = interval
+        self.spiders = spiders
+        self.tick = tick
+        self.selector = selector # called at every load, returns the filter of CSV rows handled by this process
+        self.scheduler = HostScheduler(max_per_host = max_per_host, persistent = True)
+        self.csv_signature = None
+        self.sources = {} # source id -> (host, CSV row, provider instance)
+        self.queued = set() # sources waiting for or being scraped
+        self.forced = set() # sources to scrape as soon as possible
+        self.last = {} # source id -> outcome, start and duration of the last scrape
+        self.started = time.time()
+        self.draining = None
+
+    def due_after_interval(self, sources, now):
+        return [s for s in sources if s not in self.last or self.last[s]["start"] + self.interval <= now]
+
+    # Load the CSV if it changed since the last load, keep unchanged sources
+    def load(self):
+
+        try:
+            stat = os.stat(self.csv_filename)
+        except OSError as e:
+            logging.warning("Cannot read %s: %s" % ( self.csv_filename , e ))
+            return False
+
+        signature = ( stat.st_mtime_ns , stat.st_size )
+        if signature == self.csv_signature:
+            return False
+
+        select = self.selector() if self.selector else (lambda line: True)
+        with open(self.csv_filename) as f:
+            lines = [line for line in csv.DictReader(f) if select(line)]
+
+        sources = {}
+        for line in lines:
+            p = self.provider(line)
+            if p:
+                sources[line["id"]] = ( p.host() , line , p )
+
+        added = set(sources) - set(self.sources)
+        removed = set(self.sources) - set(sources)
+        changed = set(s for s in set(sources) & set(self.sources) if sources[s][1] != self.sources[s][1])
+        self.sources = sources
+        self.csv_signature = signature
+        self.forced |= changed
+        registry.prune(sources)
+
+        logging.info("Loaded %s: %d sources (%d added, %d removed, %d changed)" % (
+            self.csv_filename, len(sources), len(added), len(removed), len(changed)
+        ))
+        return True
+
+    # Hand due sources to the spiders
+    async def dispatch(self, now = None):
+        if self.draining is not None:
+            return
+        candidates = [s for s in self.sources if s not in self.queued]
+        due = set(self.due(candidates, now or time.time())) | self.forced
+        for source in candidates:
+            if source in due:
+                host, line, p = self.sources[source]
+                self.queued.add(source)
+                await self.scheduler.submit(host, ( line , p ))
+        self.forced.clear()
+
+    async def spider(self):
+
+        while True:
+
+            job = await self.scheduler.get()
+            if job is None:
+                break
+
+            host, (line, p) = job
+            start = time.time()
+            try:
+                status = await self.scrape(line, p)
+            except Exception as e:
+                logging.warning("Error scraping source %s: %s" % ( line["id"] , e ))
+                status = "error"
+            finally:
+                self.queued.discard(line["id"])
+                await self.scheduler.done(host)
+            self.last[line["id"]] = {"status": status, "start": start, "duration": time.time() - start}
+
+    def status(self):
+        outcomes = {}
+        for last in self.last.values():
+            outcomes[last["status"]] = outcomes.get(last["status"], 0) + 1
+        return {
+            "started": self.started,
+            "uptime": time.time() - self.started,
+            "draining": self.draining is not None,
+            "csv": self.csv_filename,
+            "sources": len(self.sources),
+            "queued": self.scheduler.qsize(),
+            "running": self.scheduler.busy(),
+            "outcomes": outcomes,
+            "last": self.last
+        }
+
+    # Stop dispatching, running sources are completed
+    def drain(self):
+        if self.draining is None:
+            logging.info("Draining: %d sources running, %d queued dropped" % ( self.scheduler.busy() , self.scheduler.qsize() ))
+            self.draining = asyncio.ensure_future(self.scheduler.close())
+        return self.draining
+
+    # Control endpoint
+    def application(self):
+
+        async def status(request):
+            return web.json_response(self.status(), dumps = lambda o: json.dumps(o, sort_keys = True))
+
+        async def refresh(request):
+            source = request.match_info["source"]
+            if source not in self.sources:
+                return web.json_response({"error": "unknown source %s" % source}, status = 404)
+            if source not in self.queued:
+                self.forced.add(source)
+                await self.dispatch()
+            return web.json_response({"source": source, "queued": source in self.queued})
+
+        async def drain(request):
+            self.drain()
+            return web.json_response({"draining": True, "running": self.scheduler.busy()})
+
+        app = web.Application()
+        app.add_routes([
+            web.get("/status", status),
+            web.post("/refresh/{source}", refresh),
+            web.post("/drain", drain)
+        ])
+        return app
+
+    async def run(self, host = "127.0.0.1", port = 8760, periodic = None):
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.drain)
+
+        runner = web.AppRunner(self.application(), access_log = None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info("Daemon control endpoint on http://%s:%d/status" % ( host , port ))
+
+        self.load()
+        spiders = [asyncio.ensure_future(self.spider()) for n in range(self.spiders)]
+
+        try:
+            while self.draining is None:
+                self.load()
+                await self.dispatch()
+                if periodic:
+                    periodic()
+                await asyncio.sleep(self.tick)
+            await asyncio.gather(*spiders)
+        finally:
+            for task in spiders:
+                task.cancel()
+            await runner.cleanup()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
@@ -0,0 +1,34 @@
+# Duration of every source in previous runs (JSON file)
+#
+# Used as the cost of sources in the HostScheduler, so that the longest
+# ones start first. Durations are smoothed over runs (weight of the last
+# run), sources never scraped get the median duration of the known ones.
+
+import os, json, logging
+from providers.files import atomic_write
+
+class Durations():
+
+    def __init__(self, path, weight = 0.5):
+        self.path = path
+        self.weight = weight
+        self.durations = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.durations = json.load(f)
+            except ValueError as e:
+                logging.warning("Ignoring broken durations file %s: %s" % ( path , e ))
+        known = sorted(self.durations.values())
+        self.default = known[len(known) // 2] if known else 0.0
+
+    def get(self, source):
+        return self.durations.get(source, self.default)
+
+    def record(self, source, seconds):
+        previous = self.durations.get(source)
+        self.durations[source] = seconds if previous is None else self.weight * seconds + (1 - self.weight) * previous
+
+    def save(self):
+        with atomic_write(self.path) as f:
+            json.dump(self.durations, f, indent = 1, sort_keys = True)
@@ -0,0 +1,151 @@
+# Streaming, atomic and change-aware RSS feed writer
+#
+# Items are serialized one at a time as they come out of Provider.scrape()
+# into a temporary file next to the final one, so memory does not grow with
+# the size of the albo. The final file is replaced atomically, and only if
+# its content changed: the channel pubDate (different at every run) is left
+# out of the comparison, so unchanged feeds keep their mtime and are not
+# reprocessed downstream.
+
+import os, re, time, asyncio, hashlib, tempfile, logging
+from io import StringIO
+from xml.sax import saxutils
+from providers import metrics
+
+PUB_DATE = re.compile(r"<pubDate>.*?</pubDate>")
+
+# Files created by tempfile are private, final feeds get the usual permissions
+_umask = os.umask(0)
+os.umask(_umask)
+
+class FeedWriter():
+
+    def __init__(self, path, feed):
+        self.path = path
+        self.feed = feed
+        self.tmp_path = None
+        self.digest = None
+        self.count = 0
+        self.guids = [] # guids (or links) of written items
+
+    # Channel header and footer, rendered from the feed without items
+    def _parts(self):
+        self.feed.items = []
+        rss = self.feed.rss()
+        split = rss.rindex("</channel>")
+        return rss[:split], rss[split:]
+
+    # Serialize items (async iterable) into a temporary file
+    async def write(self, items):
+
+        with metrics.timer("feed"):
+            header, footer = self._parts()
+        hasher = hashlib.sha256(PUB_DATE.sub("", header, count = 1).encode("utf-8"))
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile("w", encoding = "utf-8", dir = directory, prefix = "." + os.path.basename(self.path), suffix = ".tmp", delete = False) as f:
+            self.tmp_path = f.name
+            try:
+                f.write(header)
+                async for item in items:
+                    with metrics.timer("feed"):
+                        chunk = self.serialize(item)
+                        f.write(chunk)
+                        hasher.update(chunk.encode("utf-8"))
+                    self.count += 1
+                    self.guids.append(item.key())
+                f.write(footer)
+                hasher.update(footer.encode("utf-8"))
+            except BaseException:
+                self.discard()
+                raise
+
+        self.digest = hasher.hexdigest()
+
+    # Item records (providers/records.py) become rfeed objects only here
+    def serialize(self, item):
+        output = StringIO()
+        item.to_item().publish(saxutils.XMLGenerator(output, "UTF-8"))
+        return output.getvalue()
+
+    # Replace the final file if its content changed, return True if replaced
+    # The temporary file is removed if the final one cannot be replaced
+    def commit(self):
+        with metrics.timer("write"):
+            try:
+                return self._commit()
+            except BaseException:
+                self.discard()
+                raise
+
+    def _commit(self):
+
+        if os.path.exists(self.path) and self.file_digest(self.path) == self.digest:
+            logging.info("Feed %s unchanged (%d items)" % ( self.path , self.count ))
+            self.discard()
+            return False
+
+        os.chmod(self.tmp_path, 0o666 & ~_umask)
+        os.replace(self.tmp_path, self.path)
+        self.tmp_path = None
+        logging.info("Feed %s written (%d items)" % ( self.path , self.count ))
+        return True
+
+    def discard(self):
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.tmp_path = None
+
+    # Digest of an existing feed, computed as in write(): the channel pubDate
+    # is in the header, before the first item (or the end of the channel)
+    @staticmethod
+    def file_digest(path, chunk_size = 65536):
+
+        hasher = hashlib.sha256()
+        header = ""
+
+        with open(path, encoding = "utf-8", errors = "replace") as f:
+
+            while True:
+                chunk = f.read(chunk_size)
+                header += chunk
+                ends = [i for i in (header.find("<item>"), header.find("</channel>")) if i >= 0]
+                if ends or not chunk:
+                    end = min(ends) if ends else len(header)
+                    hasher.update(PUB_DATE.sub("", header[:end], count = 1).encode("utf-8"))
+                    hasher.update(header[end:].encode("utf-8"))
+                    break
+
+            for chunk in iter(lambda: f.read(chunk_size), ""):
+                hasher.update(chunk.encode("utf-8"))
+
+        return hasher.hexdigest()
+
+# Wall-clock budget of a source: items(items) passes items through until
+# the budget runs out, then stops the scrape (pending pages are cancelled)
+# and sets exceeded, so that the items scraped so far make a partial feed
+class Budget():
+
+    def __init__(self, seconds = None):
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.exceeded = False
+
+    async def items(self, items):
+        items = items.__aiter__()
+        try:
+            while True:
+                try:
+                    if self.deadline is None:
+                        item = await items.__anext__()
+                    else:
+                        item = await asyncio.wait_for(items.__anext__(), self.deadline - time.monotonic())
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    if time.monotonic() < self.deadline:
+                        raise # a timeout of the scrape itself
+                    self.exceeded = True
+                    return
+                yield item
+        finally:
+            await items.aclose()
@@ -0,0 +1,184 @@
+# Aggregated, incremental index of the items of all sources
+#
+# Next to the feeds, every run appends the items that are new or changed
+# since they were last indexed, keyed by source (id column of
+# elenco_albi.csv) and guid, to:
+# - a SQLite table, where every insert or update takes a new seq number:
+#   consumers read "WHERE seq > last seq" (see delta())
+# - optionally a JSON Lines file, one record per line, only ever appended:
+#   consumers seek to the byte offset where they stopped (see read_jsonl())
+# pubStart and pubEnd are epochs, type and uid come from the item categories,
+# data is the whole item as in the item store (providers/store.py).
+# Without a SQLite path, the state used to tell new items apart is kept
+# next to the JSON Lines file (<path>.db).
+#
+# Items are not held in memory until their feed is written: as they stream
+# by, new and changed ones are staged in the pending table, then indexed by
+# commit() when the feed is committed, or dropped by discard(). Sources are
+# scraped concurrently on one connection, so staged rows are kept apart by
+# source rather than by transaction.
+
+import os, json, time, sqlite3, hashlib, logging
+from datetime import datetime
+from providers.Provider import Provider
+
+CATEGORIES = {
+    "item-category-uid": "uid",
+    "item-category-type": "type",
+    "item-category-pubStart": "pubStart",
+    "item-category-pubEnd": "pubEnd"
+}
+
+def _epoch(value):
+    try:
+        return int(datetime.strptime(value, Provider.output_format).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+# Index record of an item (ItemRecord, see providers/records.py)
+def record(source, item):
+    data = item.to_dict()
+    r = {"source": source, "guid": data["guid"] or data["link"], "uid": None, "type": None, "pubStart": None, "pubEnd": None}
+    for domain, category in data["categories"]:
+        field = CATEGORIES.get((domain or "").rsplit("#", 1)[-1])
+        if field:
+            r[field] = category
+    r["pubStart"] = _epoch(r["pubStart"])
+    r["pubEnd"] = _epoch(r["pubEnd"])
+    r["data"] = data
+    return r
+
+class ItemIndex():
+
+    def __init__(self, path = None, jsonl_path = None):
+        self.path = path or jsonl_path + ".db"
+        self.jsonl_path = jsonl_path
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT NOT NULL,
+                guid TEXT NOT NULL,
+                uid TEXT,
+                type TEXT,
+                pub_start INTEGER,
+                pub_end INTEGER,
+                data TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                first_seen INTEGER NOT NULL,
+                updated INTEGER NOT NULL,
+                UNIQUE (source, guid)
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS pending (
+                source TEXT NOT NULL,
+                guid TEXT NOT NULL,
+                uid TEXT,
+                type TEXT,
+                pub_start INTEGER,
+                pub_end INTEGER,
+                data TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                PRIMARY KEY (source, guid)
+            )
+        """)
+        self.db.commit()
+        self.added = self.updated = 0
+
+    # Pass items of source through, staging the new and changed ones
+    async def items(self, source, items):
+        # Rows left by a run that crashed before its feed was written
+        self.db.execute("DELETE FROM pending WHERE source = ?", (source,))
+        async for item in items:
+            self.stage(source, item)
+            yield item
+
+    def stage(self, source, item):
+        r = record(source, item)
+        data = json.dumps(r["data"], sort_keys = True)
+        digest = hashlib.sha1(data.encode("utf-8")).hexdigest()
+        known = self.db.execute("SELECT digest FROM items WHERE source = ? AND guid = ?", (source, r["guid"])).fetchone()
+        if known and known[0] == digest:
+            self.db.execute("DELETE FROM pending WHERE source = ? AND guid = ?", (source, r["guid"]))
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO pending (source, guid, uid, type, pub_start, pub_end, data, digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (source, r["guid"], r["uid"], r["type"], r["pubStart"], r["pubEnd"], data, digest)
+        )
+
+    # Index the rows staged for source, return the number of new or changed ones
+    def commit(self, source):
+
+        now = int(time.time())
+        changed = 0
+        jsonl = open(self.jsonl_path, "a", encoding = "utf-8") if self.jsonl_path else None
+
+        try:
+            pending = self.db.execute("SELECT guid, uid, type, pub_start, pub_end, data, digest FROM pending WHERE source = ? ORDER BY rowid", (source,)).fetchall()
+            for guid, uid, type, pub_start, pub_end, data, digest in pending:
+                known = self.db.execute("SELECT first_seen FROM items WHERE source = ? AND guid = ?", (source, guid)).fetchone()
+                event = "updated" if known else "new"
+                changed += 1
+                first_seen = now
+                if known:
+                    first_seen = known[0]
+                    self.db.execute("DELETE FROM items WHERE source = ? AND guid = ?", (source, guid))
+                    self.updated += 1
+                else:
+                    self.added += 1
+                # A new seq for every change: consumers read the delta by seq
+                cursor = self.db.execute(
+                    "INSERT INTO items (source, guid, uid, type, pub_start, pub_end, data, digest, first_seen, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (source, guid, uid, type, pub_start, pub_end, data, digest, first_seen, now)
+                )
+                if jsonl:
+                    r = {"source": source, "guid": guid, "uid": uid, "type": type, "pubStart": pub_start, "pubEnd": pub_end, "data": json.loads(data)}
+                    jsonl.write(json.dumps(dict(r, seq = cursor.lastrowid, event = event, indexed = now), sort_keys = True) + "\n")
+
+            # JSON Lines are written first: a crash in between writes a line
+            # twice at worst (same seq), never loses one
+            if jsonl:
+                jsonl.flush()
+                os.fsync(jsonl.fileno())
+        finally:
+            if jsonl:
+                jsonl.close()
+
+        self.db.execute("DELETE FROM pending WHERE source = ?", (source,))
+        self.db.commit()
+        return changed
+
+    # Drop the rows staged for source, its feed was not written
+    def discard(self, source):
+        self.db.execute("DELETE FROM pending WHERE source = ?", (source,))
+        self.db.commit()
+
+    # Records indexed after seq, as dicts with their seq
+    def delta(self, seq = 0):
+        cursor = self.db.execute("SELECT seq, source, guid, uid, type, pub_start, pub_end, data FROM items WHERE seq > ? ORDER BY seq", (seq,))
+        for row in cursor:
+            yield {
+                "seq": row[0], "source": row[1], "guid": row[2], "uid": row[3], "type": row[4],
+                "pubStart": row[5], "pubEnd": row[6], "data": json.loads(row[7])
+            }
+
+    def log_stats(self):
+        logging.info("Item index %s: %d new, %d updated items" % ( self.jsonl_path or self.path , self.added , self.updated ))
+
+    def close(self):
+        self.db.close()
+
+# Records of a JSON Lines index appended after offset (bytes), and the
+# offset to start from next time: a partially written last line is left
+# for the next call
+def read_jsonl(path, offset = 0):
+    records = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            records.append(json.loads(line))
+    return records, offset
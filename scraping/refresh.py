@@ -0,0 +1,93 @@
+# Adaptive refresh of sources, learned from their publication rate (SQLite)
+#
+# After every scrape of a source the schedule records how many guids were
+# not in its previous feed and whether the feed changed at all. Both are
+# kept as exponentially decayed counts over the observed time (half_life
+# hours), so old history fades and a source that becomes busier is caught up
+# quickly. The source is next due when, at its current rate, about
+# target_items new acts or one change are expected, within min_interval and
+# max_interval hours. A frequent cron then only scrapes the sources that are
+# due: big comuni every hour, small ones every few days.
+# Sources never scraped are always due, sources in error are retried after
+# min_interval.
+
+import json, math, time, sqlite3, logging
+
+class RefreshSchedule():
+
+    def __init__(self, path, min_interval = 1.0, max_interval = 72.0, target_items = 1.0, half_life = 168.0):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.half_life = half_life
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT PRIMARY KEY,
+                last_run REAL,
+                next_due REAL NOT NULL,
+                hours REAL NOT NULL DEFAULT 0,
+                new_items REAL NOT NULL DEFAULT 0,
+                changes REAL NOT NULL DEFAULT 0,
+                guids TEXT NOT NULL DEFAULT '[]'
+            )
+        """)
+        self.db.commit()
+
+    # Sources due at now (epoch), among sources
+    def due(self, sources, now = None):
+        now = now or time.time()
+        next_due = dict(self.db.execute("SELECT source, next_due FROM sources"))
+        return [source for source in sources if next_due.get(source, 0) <= now]
+
+    # Hours between two scrapes of a source with rate expected events per hour,
+    # an event being target_items new acts or a change of the feed
+    def interval(self, rate):
+        if rate <= 0:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, 1.0 / rate))
+
+    # Record a successful scrape: guids of the feed, None if the index was unchanged
+    def record(self, source, guids = None, changed = True, now = None):
+
+        now = now or time.time()
+        row = self.db.execute("SELECT last_run, hours, new_items, changes, guids FROM sources WHERE source = ?", (source,)).fetchone()
+
+        if row is None or row[0] is None:
+            # First scrape: the feed is the baseline, there is no rate yet
+            hours, new_items, changes, interval = 0.0, 0.0, 0.0, self.min_interval
+        else:
+            last_run, hours, new_items, changes, previous = row
+            elapsed = max(0.0, (now - last_run) / 3600.0)
+            decay = math.pow(0.5, elapsed / self.half_life)
+            new = len(set(guids) - set(json.loads(previous))) if guids is not None else 0
+            hours = hours * decay + elapsed
+            new_items = new_items * decay + new
+            changes = changes * decay + (1 if changed and guids is not None else 0)
+            interval = self.interval(max(new_items / self.target_items, changes) / hours) if hours else self.min_interval
+            if guids is None:
+                guids = json.loads(previous)
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO sources (source, last_run, next_due, hours, new_items, changes, guids) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (source, now, now + interval * 3600, hours, new_items, changes, json.dumps(list(guids or [])))
+        )
+        self.db.commit()
+        return interval
+
+    # Record a failed scrape: the source is retried after min_interval
+    def failed(self, source, now = None):
+        now = now or time.time()
+        next_due = now + self.min_interval * 3600
+        if not self.db.execute("UPDATE sources SET next_due = ? WHERE source = ?", (next_due, source)).rowcount:
+            self.db.execute("INSERT INTO sources (source, next_due) VALUES (?, ?)", (source, next_due))
+        self.db.commit()
+
+    def log_stats(self, now = None):
+        now = now or time.time()
+        total, due = self.db.execute("SELECT COUNT(*), SUM(next_due <= ?) FROM sources", (now,)).fetchone()
+        logging.info("Refresh schedule %s: %d sources known, %d due now" % ( self.path , total , due or 0 ))
+
+    def close(self):
+        self.db.close()
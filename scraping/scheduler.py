@@ -0,0 +1,97 @@
+# Per-host source scheduler, replacing the flat queue of CSV rows
+#
+# Sources are grouped by the host serving them and handed out round-robin
+# across hosts, so spiders interleave halleyweb.com sources with the other
+# hosts instead of hitting the same server all at once. At most
+# max_per_host sources of the same host are scraped at the same time:
+# a spider asking for work while every pending host is saturated waits
+# until one of its sources is done.
+# A persistent scheduler (daemon mode) keeps its spiders waiting for new
+# jobs when there are none, until it is closed.
+# Jobs can have a cost (e.g. the duration of the source in the previous
+# run): the most expensive job of a host goes first, and among hosts with
+# a free slot the one with the most expensive next job is picked, so long
+# sources start early instead of ending the run alone (longest processing
+# time first). Jobs with the same cost keep the round-robin order.
+
+import asyncio, heapq
+from collections import OrderedDict
+from itertools import count
+
+class HostScheduler():
+
+    def __init__(self, max_per_host = 4, persistent = False):
+        self.max_per_host = max_per_host
+        self.persistent = persistent
+        self.closed = False
+        self.pending = OrderedDict() # host -> heap of (-cost, n, job), hosts in round-robin order
+        self.running = {} # host -> number of sources being scraped
+        self.condition = None
+        self.counter = count()
+
+    def put(self, host, job, cost = 0):
+        heapq.heappush(self.pending.setdefault(host, []), ( -cost , next(self.counter) , job ))
+
+    def _condition(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    # Add a job while spiders are waiting for one
+    async def submit(self, host, job, cost = 0):
+        async with self._condition():
+            self.put(host, job, cost)
+            self.condition.notify_all()
+
+    # Stop handing out jobs: waiting spiders get None, pending jobs are dropped
+    async def close(self):
+        async with self._condition():
+            self.closed = True
+            dropped = [job for jobs in self.pending.values() for cost, n, job in jobs]
+            self.pending.clear()
+            self.condition.notify_all()
+        return dropped
+
+    def busy(self):
+        return sum(self.running.values())
+
+    def qsize(self):
+        return sum(len(jobs) for jobs in self.pending.values())
+
+    def hosts(self):
+        return len(set(self.pending) | set(self.running))
+
+    # Next (host, job) whose host has a free slot, None if all are saturated
+    def _next(self):
+        best = None
+        for host, jobs in self.pending.items():
+            if self.running.get(host, 0) < self.max_per_host:
+                if best is None or jobs[0][0] < self.pending[best][0][0]:
+                    best = host
+        if best is None:
+            return None
+        jobs = self.pending.pop(best)
+        job = heapq.heappop(jobs)[2]
+        if jobs:
+            self.pending[best] = jobs # back to the end of the rotation
+        self.running[best] = self.running.get(best, 0) + 1
+        return best, job
+
+    # Wait for the next job, return None when there is nothing left to do
+    async def get(self):
+        async with self._condition():
+            while True:
+                if self.closed or not (self.pending or self.persistent):
+                    return None
+                job = self._next()
+                if job:
+                    return job
+                await self.condition.wait()
+
+    # Release the slot taken by get() for host
+    async def done(self, host):
+        async with self.condition:
+            self.running[host] -= 1
+            if not self.running[host]:
+                del self.running[host]
+            self.condition.notify_all()
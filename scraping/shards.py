@@ -0,0 +1,44 @@
+# Sharding of sources across processes or nodes
+#
+# With --shard i/N every process keeps only the sources assigned to shard i
+# out of N, by consistent hashing of the id column of elenco_albi.csv: each
+# shard owns many points of a hash ring and a source belongs to the shard
+# owning the first point after the hash of its id. Sources keep their shard
+# when the CSV changes, and going from N to N+1 shards moves only about
+# 1/(N+1) of the sources.
+
+import hashlib
+from bisect import bisect
+
+POINTS = 64 # points of the ring per shard
+
+def _hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big")
+
+# Parse "i/N" (0 <= i < N) into (i, N)
+def parse(value):
+    try:
+        index, count = [int(n) for n in value.split("/")]
+    except ValueError:
+        raise ValueError("Shard must be i/N, e.g. 0/4: %s" % value)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard index must be between 0 and N-1: %s" % value)
+    return index, count
+
+class Ring():
+
+    def __init__(self, count, points = POINTS):
+        ring = sorted((_hash("shard-%d-%d" % ( shard , point )), shard) for shard in range(count) for point in range(points))
+        self.hashes = [h for h, shard in ring]
+        self.shards = [shard for h, shard in ring]
+
+    def shard(self, key):
+        return self.shards[bisect(self.hashes, _hash(key)) % len(self.hashes)]
+
+_rings = {}
+
+# Shard of a source id among count shards
+def shard_of(source, count):
+    if count not in _rings:
+        _rings[count] = Ring(count)
+    return _rings[count].shard(source)
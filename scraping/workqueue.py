@@ -0,0 +1,115 @@
+# Durable work queue of sources (SQLite), shared by processes and nodes
+#
+# Every run (--run, e.g. the start time of a cron job) has one row per
+# source. A process claims a source before scraping it, taking a lease that
+# expires after lease seconds unless renewed, and marks it done with its
+# outcome (ok, unchanged or error) at the end. A source leased by a live
+# process is skipped by the others; the lease of a crashed process expires
+# and the source is claimed again, so a restarted run resumes where it
+# stopped and skips the sources already done. Sources ending in error, or
+# whose process crashed, are tried up to max_attempts times per run.
+#
+# The database can live on a filesystem shared by several nodes, as long as
+# it supports SQLite locking.
+
+import os, time, socket, sqlite3, logging
+
+class WorkQueue():
+
+    def __init__(self, path, run, lease = 900, max_attempts = 3, owner = None):
+        self.path = path
+        self.run = run
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.owner = owner or "%s:%d" % ( socket.gethostname() , os.getpid() )
+        self.db = sqlite3.connect(path, timeout = 60, isolation_level = None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                run TEXT NOT NULL,
+                source TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                owner TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated REAL,
+                PRIMARY KEY (run, source)
+            )
+        """)
+
+    # Run statements in a write transaction, taken at once so that
+    # concurrent claims of the same source are serialized
+    def _transaction(self, statements):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements()
+            self.db.execute("COMMIT")
+            return result
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    # Add sources to the run, sources already in it keep their state
+    def add(self, sources):
+        self._transaction(lambda: self.db.executemany(
+            "INSERT OR IGNORE INTO jobs (run, source, updated) VALUES (?, ?, ?)",
+            [(self.run, source, time.time()) for source in sources]
+        ))
+
+    # Lease a source, False if it is done or leased by another live process
+    def claim(self, source):
+
+        def claim():
+            now = time.time()
+            cursor = self.db.execute("""
+                UPDATE jobs SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1, updated = ?
+                WHERE run = ? AND source = ? AND attempts < ? AND (
+                    status = 'pending' OR status = 'error' OR
+                    (status = 'leased' AND (lease_until < ? OR owner = ?))
+                )
+            """, (self.owner, now + self.lease, now, self.run, source, self.max_attempts, now, self.owner))
+            return cursor.rowcount == 1
+
+        return self._transaction(claim)
+
+    # Extend the leases of this process, to be called well within lease seconds
+    def renew(self):
+        now = time.time()
+        self._transaction(lambda: self.db.execute(
+            "UPDATE jobs SET lease_until = ?, updated = ? WHERE run = ? AND owner = ? AND status = 'leased'",
+            (now + self.lease, now, self.run, self.owner)
+        ))
+
+    # Record the outcome of a claimed source: ok, unchanged or error
+    def complete(self, source, status):
+        self._transaction(lambda: self.db.execute(
+            "UPDATE jobs SET status = ?, lease_until = NULL, updated = ? WHERE run = ? AND source = ? AND owner = ?",
+            (status, time.time(), self.run, source, self.owner)
+        ))
+
+    # Give back the sources leased by this process (e.g. on shutdown)
+    def release(self):
+        self._transaction(lambda: self.db.execute(
+            "UPDATE jobs SET status = 'pending', owner = NULL, lease_until = NULL, attempts = MAX(attempts - 1, 0), updated = ? WHERE run = ? AND owner = ? AND status = 'leased'",
+            (time.time(), self.run, self.owner)
+        ))
+
+    # Sources leased by other processes, as {source: lease expiry}
+    def leased(self):
+        return dict(self.db.execute(
+            "SELECT source, lease_until FROM jobs WHERE run = ? AND status = 'leased' AND owner != ? AND attempts < ?",
+            (self.run, self.owner, self.max_attempts)
+        ))
+
+    # Number of sources of the run by status
+    def counts(self):
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs WHERE run = ? GROUP BY status", (self.run,)))
+
+    def log_stats(self):
+        counts = self.counts()
+        logging.info("Work queue %s, run %s: %s" % (
+            self.path, self.run, ", ".join("%d %s" % ( n , status ) for status, n in sorted(counts.items())) or "empty"
+        ))
+
+    def close(self):
+        self.db.close()
@@ -1,30 +1,74 @@
-import sys, csv
-from providers import providers
-
-if len(sys.argv) > 1:
-    csv_filename = sys.argv[1].strip()
-else:
-    print("Usage: python %s %s" % (
-        sys.argv[0],
-        "[CSV filename]"
-    ))
-    exit()
-
-with open(sys.argv[1]) as f:
-
-    reader = csv.DictReader(f)
-    for line in reader:
-
-        try:
-            p = getattr(providers, line["provider"])()
-            p.opts(line["options"])
-        except AttributeError as e:
-            logging.warning("Requested provider not found: %s" % line["provider"])
-            q.task_done()
-            continue
-
-        urls = [url for url in p.urls()]
-        print(urls)
-        items = [item for item in p.items(urls)]
-        print(items)
+import csv, time, logging, argparse, asyncio
+from providers import providers, fetch, cassettes
+from providers.profiler import Profiler
 
+parser = argparse.ArgumentParser(description = "Print the urls and items of every source of a CSV file")
+parser.add_argument("csv_filename", help = "CSV file of sources (like elenco_albi.csv)")
+parser.add_argument("--record", help = "save the responses of every source in a cassette (<id>.cassette) in this directory")
+parser.add_argument("--replay", help = "serve responses from the cassettes in this directory, without network access")
+parser.add_argument("--profile", help = "sample the stacks of every source and write <id>.collapsed and profile_summary.txt in this directory")
+parser.add_argument("--profile-threshold", type = float, default = 0, help = "only write the profiles of sources taking at least these seconds (default: 0)")
+args = parser.parse_args()
+
+if args.record and args.replay:
+    parser.error("--record and --replay cannot be used together")
+
+logging.basicConfig(level = logging.INFO)
+
+profiler = Profiler(args.profile, threshold = args.profile_threshold) if args.profile else None
+
+async def test(p):
+    urls = [url async for url in p.urls()]
+    print(urls)
+    items = [item async for item in p.items(urls)]
+    print(items)
+
+async def main():
+
+    failed = 0
+
+    with open(args.csv_filename.strip()) as f:
+
+        reader = csv.DictReader(f)
+        for line in reader:
+
+            try:
+                p = getattr(providers, line["provider"])()
+                p.opts(line["options"])
+                p.source = line["id"]
+            except AttributeError:
+                logging.warning("Requested provider not found: %s" % line["provider"])
+                failed += 1
+                continue
+
+            start = time.perf_counter()
+            try:
+                if args.record or args.replay:
+                    with cassettes.for_source(args.record or args.replay, line["id"], "record" if args.record else "replay"):
+                        await test(p)
+                else:
+                    await test(p)
+            except Exception as e:
+                logging.warning("Error testing source %s: %s" % ( line["id"] , e ))
+                failed += 1
+            else:
+                # Single item pages that failed (e.g. missing from a cassette) are dropped by items()
+                if p.errors:
+                    logging.warning("Error testing source %s: %d pages failed" % ( line["id"] , p.errors ))
+                    failed += 1
+            if profiler:
+                profiler.finish(line["id"], time.perf_counter() - start)
+
+    await fetch.close()
+    return failed
+
+if profiler:
+    profiler.start()
+
+failed = asyncio.run(main())
+
+if profiler:
+    profiler.stop()
+
+# Non-zero exit status if any source or page failed, for CI runs with --replay
+exit(1 if failed else 0)